@@ -0,0 +1,97 @@
+import glob
+import json
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import cached_assemble, cached_compile, cached_tokenize
+from channels import InputChannel, OutputChannel
+from compiler import load_stdlib
+from emulator import emulate
+from lmo import read_object
+from interpreter import interpret
+
+_stdlib = None
+
+
+def warm():
+    # Runs once in each worker process so that jobs don't pay for reading the
+    # standard library (or importing the tools) again.
+    global _stdlib
+    _stdlib = load_stdlib()
+
+
+def read_manifest(path):
+    jobs = []
+    base = os.path.dirname(path)
+    with open(path, "r") as file:
+        for i, line in enumerate(file):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                raise Exception(f"Malformed manifest entry at line {i + 1}.")
+            jobs.append({
+                "file": os.path.join(base, entry["file"]),
+                "stdin": entry.get("stdin", ""),
+            })
+    return jobs
+
+
+def collect_jobs(target):
+    target = str(target)
+    if os.path.isdir(target):
+        paths = [os.path.join(target, name) for name in os.listdir(target)]
+    elif target.endswith(".jsonl"):
+        return read_manifest(target)
+    else:
+        paths = glob.glob(target)
+    paths = sorted(path for path in paths if os.path.isfile(path) and os.path.splitext(path)[1] in [".bmc", ".lmc", ".lmo"])
+    return [{ "file": path, "stdin": "" } for path in paths]
+
+
+def run_job(job, engine="emulate", jit=False, cache=None):
+    stdlib = _stdlib if _stdlib is not None else load_stdlib()
+    stdin = InputChannel.from_text(job["stdin"])
+    output = OutputChannel()
+    error = None
+    start = time.perf_counter()
+
+    try:
+        if job["file"].endswith(".lmo"):
+            code, _ = read_object(job["file"])
+        else:
+            with open(job["file"], "r") as file:
+                code = file.read()
+        if engine == "interpret" and job["file"].endswith(".bmc"):
+            interpret(cached_tokenize(code, cache), output)
+        else:
+            if job["file"].endswith(".bmc"):
+                code = cached_compile(code, cache, stdlib).instructions
+            if not isinstance(code, array):
+                code = cached_assemble(code, cache)
+            emulate(code, jit=jit, stdin=stdin, stdout=output)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return {
+        "file": job["file"],
+        "status": 0 if error is None else 1,
+        "output": output.getvalue(),
+        "error": error,
+        "time": round(time.perf_counter() - start, 6),
+    }
+
+
+def run_batch(jobs, out=sys.stdout, workers=None, engine="emulate", jit=False, cache=None):
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm) as executor:
+        results = executor.map(run_job, jobs, [engine] * len(jobs), [jit] * len(jobs), [cache] * len(jobs))
+        for result in results:
+            failures += result["status"] != 0
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    return failures
@@ -1,42 +1,83 @@
 import argparse
+import os
 import pathlib
+import sys
+from array import array
 
-from emulator import emulate
-from parser import tokenize
-from interpreter import interpret
-from compiler import compile
+from emulator import assemble_object, emulate
+from lmo import read_object, write_object
+from interpreter import DEFAULT_MEMO_SIZE, Memo, interpret
+from batch import collect_jobs, run_batch
+from cache import Cache, cached_assemble, cached_compile, cached_tokenize
+from parser import tokenize_stream
+from channels import console_input, console_output
+from compiler import MEMO_TABLE_SIZE
 
 ap = argparse.ArgumentParser(description="Compile or interpret BMC code.")
-ap.add_argument("mode", choices=["compile", "interpret", "compare", "emulate"])
-ap.add_argument("--file", "-f", required=True, type=pathlib.Path, help="Specify an input file of BMC (or LMC in emulate mode) code.")
-ap.add_argument("--output", "-o", nargs="?", const=-1, action="store", type=pathlib.Path, help="Specify a file in which to dump compiled LMC code.")
+ap.add_argument("mode", choices=["compile", "interpret", "compare", "emulate", "batch"])
+ap.add_argument("--file", "-f", required=True, type=pathlib.Path, help="Specify an input file of BMC (or LMC/LMO in emulate mode) code. In batch mode, a directory, glob or .jsonl manifest of jobs.")
+ap.add_argument("--output", "-o", nargs="?", const=-1, action="store", type=pathlib.Path, help="Specify a file in which to dump compiled LMC code (or batch results). A .lmo extension writes an assembled object instead.")
 ap.add_argument("--dump", "-d", action="store_true", help="Dump the contents of the stack/memory after execution.")
 ap.add_argument("--exec", "-E", action="store_true", help="Emulate the compiled LMC code")
+ap.add_argument("--jit", action="store_true", help="Compile hot basic blocks to Python while emulating.")
+ap.add_argument("--jobs", "-j", type=int, help="Number of worker processes to use in batch mode.")
+ap.add_argument("--cache-dir", default=os.environ.get("BMC_CACHE_DIR"), help="Cache compiled and assembled code in this directory (defaults to $BMC_CACHE_DIR).")
+ap.add_argument("--memo", type=int, nargs="?", const=-1, default=0, metavar="SIZE", help=f"Memoize pure functions, keeping up to SIZE results for each, and report cache hits and misses. The interpreter keeps the last {DEFAULT_MEMO_SIZE} results by default. Compiled code gives each memoized function two tables of SIZE words, covering arguments below SIZE (default {MEMO_TABLE_SIZE}).")
+ap.add_argument("-O", dest="level", type=int, choices=[0, 1, 2], default=0, help="Peephole optimization level for compiled code (default 0).")
+ap.add_argument("--engine", choices=["emulate", "interpret"], default="emulate", help="How to run BMC files in batch mode.")
 
 def main():
     args = ap.parse_args()
     mode = args.mode
-    if mode not in ["compile", "compare"] and args.output is not None:
+    if mode not in ["compile", "compare", "batch"] and args.output is not None:
         ap.error("--output cannot be specified when there is no code to output.")
     if mode == "compile" and not args.exec and args.dump:
         ap.error("Cannot dump memory when no code is being executed.")
     if args.exec and mode != "compile":
         ap.error("--exec cannot be used outside of 'compile' mode.")
+    if args.jit and mode not in ["emulate", "compare", "batch"] and not args.exec:
+        ap.error("--jit can only be used when LMC code is being emulated.")
+    if mode == "batch" and args.dump:
+        ap.error("Cannot dump memory in 'batch' mode.")
+    if args.memo and mode in ["emulate", "batch"]:
+        ap.error("--memo can only be used when BMC code is being compiled or interpreted.")
+
+    cache = Cache(args.cache_dir) if args.cache_dir else None
+
+    if mode == "batch":
+        jobs = collect_jobs(args.file)
+        if args.output is not None and args.output != -1:
+            with open(args.output, "w") as out_file:
+                failures = run_batch(jobs, out_file, args.jobs, args.engine, args.jit, cache)
+        else:
+            failures = run_batch(jobs, sys.stdout, args.jobs, args.engine, args.jit, cache)
+        if failures > 0:
+            sys.exit(1)
+        return
+
+    stdout = console_output()
+    stdin = console_input(stdout)
 
     code = None
-    with open(args.file, "r") as file:
-        code = file.read()
+    if mode == "emulate" and args.file.suffix == ".lmo":
+        code, _ = read_object(args.file)
+    elif mode != "interpret" or cache is not None or args.memo:
+        with open(args.file, "r") as file:
+            code = file.read()
 
     compiled = None
     if mode in ["compile", "compare"]:
-        tokens = tokenize(code)
-        compiled = compile(tokens)
+        memo = MEMO_TABLE_SIZE if args.memo < 0 else args.memo
+        compiled = cached_compile(code, cache, memo=memo, level=args.level)
 
         if args.output is not None:
             in_path = str(args.file)
             file_name = args.output if args.output != -1 else in_path[:in_path.rindex(".")] + ".lmc"
-            with open(file_name, "w") as out_file:
-                out_file.write(compiled)
+            if pathlib.Path(file_name).suffix == ".lmo":
+                write_object(file_name, *assemble_object(compiled.instructions))
+            else:
+                with open(file_name, "w") as out_file:
+                    out_file.write(str(compiled))
         elif mode != "compare":
             print(compiled)
 
@@ -44,23 +85,42 @@ def main():
         if mode == "compare":
             print("== INTERPRETED ==")
         
-        tokens = tokenize(code)
-        stack = interpret(tokens)
+        if code is None:
+            # Without a cache, the interpreter runs each statement as soon as
+            # it has been read and parsed.
+            with open(args.file, "r") as file:
+                stack = interpret(tokenize_stream(file), stdout)
+        else:
+            memo = None
+            if args.memo:
+                memo = Memo(DEFAULT_MEMO_SIZE if args.memo < 0 else args.memo)
+            stack = interpret(cached_tokenize(code, cache), stdout, memo)
+            if memo is not None:
+                stdout.flush()
+                print(f"memo: {memo.hits} hits, {memo.misses} misses", file=sys.stderr)
         
         if args.dump:
             print(stack)
         
     if mode == "compare" or args.exec:
-        code = compiled
+        code = compiled.instructions
 
     if mode in ["emulate", "compare"] or args.exec:
         if mode == "compare":
             print("\n== COMPILED ==")
         
-        memory = emulate(code)
+        labels = None
+        if args.memo:
+            code, labels = assemble_object(code)
+        elif not isinstance(code, array):
+            code = cached_assemble(code, cache)
+        memory = emulate(code, jit=args.jit, stdin=stdin, stdout=stdout)
+        if labels is not None:
+            hits, misses = memory[labels["_memo_hits"]], memory[labels["_memo_misses"]]
+            print(f"memo: {hits} hits, {misses} misses", file=sys.stderr)
         
         if args.dump:
-            print(memory)
+            print(memory.tolist())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+import compiler
+import emulator
+import fold
+import linker
+import lmo
+import nodes
+import parser
+import peephole
+import purity
+import resolver
+import tailcall
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def tool_version():
+    # Results depend on the code of the tools that produced them, so the
+    # sources of those modules stand in for a version number.
+    digest = hashlib.sha256()
+    for module in [parser, nodes, resolver, purity, tailcall, fold, linker, peephole, compiler, emulator, lmo]:
+        with open(module.__file__, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class Cache():
+    # A content-addressed store of tool results. Entries are files named by a
+    # hash of their inputs; reading an entry refreshes its modification time,
+    # and the least recently used entries are removed once the directory grows
+    # past max_size bytes.
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.version = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, kind, *parts):
+        if self.version is None:
+            self.version = tool_version()
+        digest = hashlib.sha256()
+        for part in [self.version, kind, *parts]:
+            part = part.encode("utf-8")
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def load(self, key, ext, reader):
+        # Workers share the directory, so an entry can be evicted by another
+        # process at any point. A truncated or corrupt entry is removed and
+        # treated as a miss.
+        path = self.path(key, ext)
+        try:
+            value = reader(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return value
+
+    def store(self, key, ext, writer):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            writer(tmp_path)
+            os.replace(tmp_path, self.path(key, ext))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def read_pickle(path):
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+def write_pickle(value):
+    def writer(path):
+        with open(path, "wb") as file:
+            pickle.dump(value, file)
+    return writer
+
+
+def cached_tokenize(code, cache=None):
+    if cache is None:
+        return parser.tokenize(code)
+    key = cache.key("tokens", code)
+    tokens = cache.load(key, ".tokens", read_pickle)
+    if tokens is None:
+        tokens = parser.tokenize(code)
+        cache.store(key, ".tokens", write_pickle(tokens))
+    return tokens
+
+
+def cached_compile(code, cache=None, stdlib=None, memo=0, level=0):
+    if stdlib is None:
+        stdlib = compiler.load_stdlib()
+    if cache is None:
+        return compiler.compile(parser.tokenize(code), stdlib, memo, level)
+    key = cache.key("program", code, str(memo), str(level), *(f"{name}\0{text}" for name, text in sorted(stdlib.items())))
+    program = cache.load(key, ".program", read_pickle)
+    if program is None:
+        program = compiler.compile(cached_tokenize(code, cache), stdlib, memo, level)
+        cache.store(key, ".program", write_pickle(program))
+    return program
+
+
+def cached_assemble(code, cache=None):
+    # Only LMC source is cached. Compiled programs are already parsed, so
+    # assembling them is cheap.
+    if cache is None or not isinstance(code, str):
+        return emulator.assemble(code)
+    key = cache.key("object", code)
+    object = cache.load(key, ".lmo", lambda path: lmo.read_object(path)[0])
+    if object is None:
+        object, labels = emulator.assemble_object(code)
+        cache.store(key, ".lmo", lambda path: lmo.write_object(path, object, labels))
+    return object
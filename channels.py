@@ -0,0 +1,131 @@
+import re
+import sys
+
+int_expr = re.compile(r"[ \t\r\n]*(-?[0-9]+)")
+
+
+class InputChannel():
+    # Reads integers (INP) and characters (ITC) from one shared stream of text.
+    # The text arrives in chunks, pulled only when the buffer runs dry, so the
+    # same channel can sit on a string, a file, an iterator of values or an
+    # interactive prompt.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    @classmethod
+    def from_text(cls, text):
+        return cls([text])
+
+    @classmethod
+    def from_file(cls, file, chunk_size=1 << 16):
+        return cls(iter(lambda: file.read(chunk_size), ""))
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(f"{value}\n" for value in values)
+
+    @classmethod
+    def prompt(cls, before=None):
+        def lines():
+            while True:
+                if before is not None:
+                    before()
+                try:
+                    yield input(" > ") + "\n"
+                except EOFError:
+                    return
+        return cls(lines())
+
+    def refill(self):
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def read_int(self):
+        while True:
+            match = int_expr.match(self.buffer, self.pos)
+            # A number that runs up to the end of the buffer may continue in
+            # the next chunk.
+            if match is None:
+                rest = self.buffer[self.pos:]
+                partial = rest.strip() in ["", "-"]
+            else:
+                partial = match.end() == len(self.buffer)
+            if partial and self.refill():
+                continue
+            if match is None:
+                if rest.strip() == "":
+                    raise Exception("Ran out of input.")
+                raise Exception(f"Expected an integer on input, found '{rest.split()[0]}'.")
+            self.pos = match.end()
+            return int(match.group(1))
+
+    def read_char(self):
+        # Returns 0 once the input is exhausted.
+        while self.pos >= len(self.buffer):
+            if not self.refill():
+                return 0
+        char = self.buffer[self.pos]
+        self.pos += 1
+        return ord(char)
+
+
+class OutputChannel():
+    # Collects OUT/OTC (and the interpreter's '.') output and writes it to the
+    # underlying file in bulk. Without a file, output is only collected and can
+    # be read back with getvalue().
+    def __init__(self, file=None, buffer_size=1024):
+        self.file = file
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.written = []
+
+    def write(self, text):
+        self.buffer.append(text)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_int(self, value):
+        self.write(f"{value}\n")
+
+    def write_char(self, value):
+        # OTC is valid on any accumulator, so values that aren't a character
+        # are written as "?" rather than stopping the program.
+        self.write(chr(value) if 0 <= value < 0x110000 else "?")
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        text = "".join(self.buffer)
+        self.buffer = []
+        if self.file is None:
+            self.written.append(text)
+        else:
+            self.file.write(text)
+            self.file.flush()
+
+    def getvalue(self):
+        self.flush()
+        return "".join(self.written)
+
+
+def console_output():
+    # Writes straight through when a person may be typing input, so output is
+    # never held back behind a prompt.
+    return OutputChannel(sys.stdout, 1 if sys.stdin.isatty() else 1024)
+
+
+def console_input(output=None):
+    if sys.stdin.isatty():
+        return InputChannel.prompt(output.flush if output is not None else None)
+    return InputChannel.from_file(sys.stdin)
@@ -1,6 +1,15 @@
 from os import listdir
 from os.path import isfile, join as join_path, split as split_path, splitext
 
+from nodes import NUM, OP, REFERENCE, CONSTANT, IF, IF_ELSE, FUNCTION
+from emulator import DIRECT, IMMEDIATE, INDIRECT
+from fold import fold_constants
+from linker import link, prune_functions
+from peephole import optimize
+from purity import mark_pure
+from resolver import Globals, linked_functions, resolve
+from tailcall import mark_tail_calls
+
 def load_stdlib():
     stdlib = {}
 
@@ -19,6 +28,12 @@ def load_stdlib():
     return stdlib
 
 
+SMALL_FACTOR = 16
+
+# Each memoized function carries two tables of this many words, one of
+# results and one of flags, so the default is kept small.
+MEMO_TABLE_SIZE = 64
+
 _ret_n = 0
 def next_ret():
     global _ret_n
@@ -26,214 +41,433 @@ def next_ret():
     return "ret" + str(_ret_n).zfill(3)
 
 
-def translate(token, args=None):
-    type, value = token.values()
-    
-    if type == "nop":
-        return []
+def ins(mnemonic, mode=IMMEDIATE, operand=None, label=None):
+    # One instruction of compiled code, as the peephole optimizer and the
+    # linker take it. mnemonic may name a standard library macro.
+    return (label, mnemonic, mode, operand)
+
+
+def memo_index(size, out_of_range):
+    # Loads the only argument of the current function into _c, jumping to
+    # out_of_range unless it is a valid index into a memo table.
+    positive = next_ret()
+    in_range = next_ret()
+    return [
+        ins("LDA", DIRECT, "_bp"),
+        ins("SUB", IMMEDIATE, 3),
+        ins("STA", DIRECT, "_d"),
+        ins("LDA", INDIRECT, "_d"),
+        ins("STA", DIRECT, "_c"),
+        ins("BRZ", IMMEDIATE, in_range),
+        ins("BRP", IMMEDIATE, positive),
+        ins("BRA", IMMEDIATE, out_of_range),
+        ins("SUB", IMMEDIATE, size, positive),
+        ins("BRP", IMMEDIATE, out_of_range),
+        ins("BRZ", IMMEDIATE, out_of_range),
+        ins("NOP", label=in_range),
+    ]
+
+
+def memoize(block, size):
+    # Wraps the body of a pure one-argument function in a lookup in, and a
+    # store to, a direct-mapped table of results indexed by the argument.
+    # Returns the new body and the table cells.
+    values = next_ret()
+    valid = next_ret()
+    miss = next_ret()
+    done = next_ret()
+    return [
+        *memo_index(size, miss),
+        ins("LDA", IMMEDIATE, valid),
+        ins("ADD", DIRECT, "_c"),
+        ins("STA", DIRECT, "_d"),
+        ins("LDA", INDIRECT, "_d"),
+        ins("BRZ", IMMEDIATE, miss),
+        ins("LDA", DIRECT, "_memo_hits"),
+        ins("ADD", IMMEDIATE, 1),
+        ins("STA", DIRECT, "_memo_hits"),
+        ins("LDA", IMMEDIATE, values),
+        ins("ADD", DIRECT, "_c"),
+        ins("STA", DIRECT, "_d"),
+        ins("LDA", INDIRECT, "_d"),
+        ins("PUSHACC"),
+        ins("BRA", IMMEDIATE, done),
+        ins("LDA", DIRECT, "_memo_misses", miss),
+        ins("ADD", IMMEDIATE, 1),
+        ins("STA", DIRECT, "_memo_misses"),
+        *block,
+        *memo_index(size, done),
+        ins("LDA", IMMEDIATE, valid),
+        ins("ADD", DIRECT, "_c"),
+        ins("STA", DIRECT, "_d"),
+        ins("LDA", IMMEDIATE, 1),
+        ins("STA", INDIRECT, "_d"),
+        ins("LDA", IMMEDIATE, values),
+        ins("ADD", DIRECT, "_c"),
+        ins("STA", DIRECT, "_b"),
+        ins("PEEK", IMMEDIATE, 0),
+        ins("STA", INDIRECT, "_b"),
+        ins("NOP", label=done),
+    ], [
+        ins("DAT", label=values),
+        *([ins("DAT")] * (size - 1)),
+        ins("DAT", label=valid),
+        *([ins("DAT")] * (size - 1)),
+    ]
+
+
+def literal(token):
+    # The value the compiled code pushes for a number.
+    return token.value if token.exact else token.value % 255
+
+
+def multiply_by(factor):
+    # Multiplies the accumulator by a small constant with a chain of
+    # doublings and additions, instead of calling std_mul.
+    if factor == 0:
+        return [ins("LDA", IMMEDIATE, 0)]
+    bits = bin(factor)[3:]
+    asm = []
+    if "1" in bits:
+        asm.append(ins("STA", DIRECT, "_a"))
+    for bit in bits:
+        asm += [ins("STA", DIRECT, "_b"), ins("ADD", DIRECT, "_b")]
+        if bit == "1":
+            asm.append(ins("ADD", DIRECT, "_a"))
+    return asm
+
 
-    if type == "num":
+# The top of the stack is kept in the accumulator between tokens when it can
+# be, rather than pushed to the stack in memory and popped straight back off.
+# cached says whether it is: True when the value on top of the stack is in
+# the accumulator and the rest of the stack is in memory, False when the
+# whole stack is in memory, and None after a tail call, which never falls
+# through to the next token.
+
+def spill(cached):
+    # Puts the whole stack in memory.
+    return [ins("PUSHACC")] if cached else []
+
+
+def take(cached):
+    # Takes the top of the stack off into the accumulator.
+    return [] if cached else [ins("POP")]
+
+
+def merge(a, b):
+    # The state two branches agree on when they join, and whether each of
+    # them has to spill to reach it.
+    if a is None or b is None or a == b:
+        state = b if a is None else a
+        return state, False, False
+    return False, a, b
+
+
+def call_std(routine, ret, cached):
+    # Calls a standard library routine on the top two values of the stack,
+    # leaving ret as the label the routine returns to.
+    return [
+        *spill(cached),
+        ins("PUSH", IMMEDIATE, ret),
+        ins("BRA", IMMEDIATE, routine),
+    ]
+
+
+def translate(token, scopes=(), memo=0, cached=False):
+    # Returns the code for token and whether the top of the stack is left in
+    # the accumulator after it.
+    kind = token.kind
+
+    if kind == NUM:
         return [
-            "PUSH #{}".format(value % 255)
-        ]
+            *spill(cached),
+            ins("LDA", IMMEDIATE, literal(token))
+        ], True
     
-    elif type == "function":
+    elif kind == FUNCTION:
         lbl = next_ret()
         skip = next_ret()
-        block = translate_sequence(value["block"], value["args"])
+        # A function that reads the arguments of the calls it is nested in
+        # keeps a link to the frame of the call that defined it, set each
+        # time the definition runs. Its parent names the cell, as it saves
+        # the link on entry and puts it back on return.
+        link = scopes[-1][2].get(id(token)) if len(scopes) > 0 else None
+        links = {id(func): next_ret() for func in linked_functions(token.block)}
+        block, result = translate_sequence(token.block, (*scopes, (token.args, link, links)), memo)
+        tables = [] if link is None else [ins("DAT", label=link)]
+        if memo > 0 and token.pure and len(token.args) == 1:
+            block, memo_tables = memoize([*block, *spill(result)], memo)
+            tables += memo_tables
+            result = False
+        # Functions return their result in the accumulator.
         return [
-            f"BRA {skip}",
-            f"{lbl} NOP",
+            *spill(cached),
+            ins("BRA", IMMEDIATE, skip),
+            ins("NOP", label=lbl),
+            *(ins("PUSH", DIRECT, label) for label in links.values()),
             *block,
-            "POP",
-            "STA &_a",
-            "POP",
-            "STA &_b",
-            "POP",
-            "STA &_d",
-            *(["POP"] * len(value["args"])),
-            "LDA &_b",
-            "STA &_bp",
-            "PUSH &_a",
-            "BRA &_d",
-            f"{skip} PUSH #{lbl}"
-        ]
+            *take(result),
+            ins("STA", DIRECT, "_a"),
+            *(line for label in reversed(links.values()) for line in [ins("POP"), ins("STA", DIRECT, label)]),
+            ins("POP"),
+            ins("STA", DIRECT, "_b"),
+            ins("POP"),
+            ins("STA", DIRECT, "_d"),
+            *([ins("LDA", DIRECT, "_sp"), ins("SUB", IMMEDIATE, len(token.args)), ins("STA", DIRECT, "_sp")] if len(token.args) > 0 else []),
+            ins("LDA", DIRECT, "_b"),
+            ins("STA", DIRECT, "_bp"),
+            ins("LDA", DIRECT, "_a"),
+            ins("BRA", DIRECT, "_d"),
+            *tables,
+            *([ins("LDA", IMMEDIATE, lbl, skip)] if link is None else [
+                ins("LDA", DIRECT, "_bp", skip),
+                ins("STA", DIRECT, link),
+                ins("LDA", IMMEDIATE, lbl),
+            ]),
+        ], True
     
-    elif type == "constant":
-        name = value
+    elif kind == CONSTANT:
+        name = token.name
         skip = next_ret()
         return [
-            f"BRA {skip}",
-            f"{name} DAT",
-            f"{skip} POP",
-            f"STA &{name}"
-        ]
+            ins("BRA", IMMEDIATE, skip),
+            ins("DAT", label=name),
+            ins("NOP", label=skip),
+            *take(cached),
+            ins("STA", DIRECT, name)
+        ], False
     
-    elif type == "reference":
-        name = value
-        if args is not None and name in args:
-            index = len(args) - args.index(name) + 2
+    elif kind == REFERENCE:
+        name = token.name
+        if token.depth is not None:
+            # The function depth - 1 levels out links to the frame of the
+            # call it was defined in, which holds the argument. The link is 0
+            # when that call has returned.
+            index = len(scopes[-1 - token.depth][0]) - token.slot + 2
+            base = "_bp" if token.depth == 0 else scopes[-token.depth][1]
             return [
-                f"LDA &_bp",
-                f"SUB #{index}",
-                "STA &_d",
-                "LDA ~_d",
-                "PUSHACC"
-            ]
+                *spill(cached),
+                ins("LDA", DIRECT, base),
+                *([] if token.depth == 0 else [ins("BRZ", IMMEDIATE, "std_unlinked")]),
+                ins("SUB", IMMEDIATE, index),
+                ins("STA", DIRECT, "_d"),
+                ins("LDA", INDIRECT, "_d"),
+            ], True
         else:
             return [
-                f"PUSH &{name}"
-            ]
+                *spill(cached),
+                ins("LDA", DIRECT, name)
+            ], True
 
-    if type == "if":
-        block = translate_sequence(value, args)
+    if kind == IF:
+        block, result = translate_sequence(token.block, scopes, memo)
         end = next_ret()
         return [
-            "POP",
-            f"BRZ {end}",
+            *take(cached),
+            ins("BRZ", IMMEDIATE, end),
             *block,
-            f"{end} NOP"
-        ]
+            *spill(result),
+            ins("NOP", label=end)
+        ], False
 
-    if type == "if-else":
-        if_block = translate_sequence(value[0], args)
-        else_block = translate_sequence(value[1], args)
+    if kind == IF_ELSE:
+        if_block, if_result = translate_sequence(token.block, scopes, memo)
+        else_block, else_result = translate_sequence(token.else_block, scopes, memo)
+        result, if_spill, else_spill = merge(if_result, else_result)
         elze = next_ret()
         end = next_ret()
         return [
-            "POP",
-            f"BRZ {elze}",
+            *take(cached),
+            ins("BRZ", IMMEDIATE, elze),
             *if_block,
-            f"BRA {end}",
-            f"{elze} NOP",
+            *spill(if_spill),
+            ins("BRA", IMMEDIATE, end),
+            ins("NOP", label=elze),
             *else_block,
-            f"{end} NOP"
-        ]
+            *spill(else_spill),
+            ins("NOP", label=end)
+        ], result
 
-    if type == "op":
-        op = value
+    if kind == OP:
+        op = token.op
         # ADD
         if op == "+":
             return [
-                "POP",
-                "STA &_a",
-                "POP",
-                "ADD &_a",
-                "PUSHACC",
-            ]
+                *take(cached),
+                ins("STA", DIRECT, "_a"),
+                ins("POP"),
+                ins("ADD", DIRECT, "_a"),
+            ], True
         # SUBTRACT
         if op == "-":
             return [
-                "POP",
-                "STA &_a",
-                "POP",
-                "SUB &_a",
-                "PUSHACC",
-            ]
+                *take(cached),
+                ins("STA", DIRECT, "_a"),
+                ins("POP"),
+                ins("SUB", DIRECT, "_a"),
+            ], True
         # MULTIPLY
         if op == "*":
             ret = next_ret()
             return [
-                f"PUSH #{ret}",
-                "BRA std_mul",
-                f"{ret} PUSHACC",
-            ]
+                *call_std("std_mul", ret, cached),
+                ins("NOP", label=ret),
+            ], True
         # DIVIDE
         if op == "/":
             ret = next_ret()
             return [
-                f"PUSH #{ret}",
-                "BRA std_div",
-                f"{ret} PUSHACC",
-            ]
+                *call_std("std_div", ret, cached),
+                ins("NOP", label=ret),
+            ], True
         # MODULO
         if op == "%":
             ret = next_ret()
             return [
-                f"PUSH #{ret}",
-                "BRA std_div",
-                f"{ret} LDA &_b",
-                "PUSHACC",
-            ]
+                *call_std("std_div", ret, cached),
+                ins("LDA", DIRECT, "_b", ret),
+            ], True
         # EQUALS
         if op == "=":
             equal = next_ret()
             end = next_ret()
             return [
-                "POP",
-                "STA &_a",
-                "POP",
-                "SUB &_a",
-                f"BRZ {equal}",
-                "PUSH #0",
-                f"BRA {end}",
-                f"{equal} PUSH #1",
-                f"{end} NOP"
-            ]
+                *take(cached),
+                ins("STA", DIRECT, "_a"),
+                ins("POP"),
+                ins("SUB", DIRECT, "_a"),
+                ins("BRZ", IMMEDIATE, equal),
+                ins("LDA", IMMEDIATE, 0),
+                ins("BRA", IMMEDIATE, end),
+                ins("LDA", IMMEDIATE, 1, equal),
+                ins("NOP", label=end)
+            ], True
         # NOT
         if op == "~":
             zero = next_ret()
             end = next_ret()
             return [
-                "POP",
-                f"BRZ {zero}",
-                "PUSH #0",
-                f"BRA {end}",
-                f"{zero} PUSH #1",
-                f"{end} NOP"
-            ]
+                *take(cached),
+                ins("BRZ", IMMEDIATE, zero),
+                ins("LDA", IMMEDIATE, 0),
+                ins("BRA", IMMEDIATE, end),
+                ins("LDA", IMMEDIATE, 1, zero),
+                ins("NOP", label=end)
+            ], True
         # PRINT
         if op == ".":
             return [
-                "POP",
-                "OUT",
-            ]
+                *take(cached),
+                ins("OUT"),
+            ], False
         # VOID
         if op == "void":
             return [
-                "POP"
-            ]
+                *take(cached),
+            ], False
         # PEEK
         if op == "@":
             return [
-                "POP",
-                "STA &_a",
-                "PEEK &_a",
-                "PUSHACC"
-            ]
+                *take(cached),
+                ins("STA", DIRECT, "_a"),
+                ins("PEEK", DIRECT, "_a"),
+            ], True
+        # TAIL CALL
+        if op == "!" and token.tail and token.callee is not None:
+            # Moves the callee's arguments down over the caller's frame and
+            # jumps to it with the caller's return address and base pointer.
+            frame_size = len(scopes[-1][0]) + 2
+            moves = []
+            for i in range(len(token.callee.args)):
+                moves += [
+                    ins("LDA", DIRECT, "_bp"),
+                    ins("ADD", IMMEDIATE, i),
+                    ins("STA", DIRECT, "_d"),
+                    ins("LDA", INDIRECT, "_d"),
+                    ins("PUSHACC"),
+                ]
+            return [
+                *take(cached),
+                ins("STA", DIRECT, "_c"),
+                ins("LDA", DIRECT, "_bp"),
+                ins("SUB", IMMEDIATE, 2),
+                ins("STA", DIRECT, "_d"),
+                ins("LDA", INDIRECT, "_d"),
+                ins("STA", DIRECT, "_a"),
+                ins("LDA", DIRECT, "_bp"),
+                ins("SUB", IMMEDIATE, 1),
+                ins("STA", DIRECT, "_d"),
+                ins("LDA", INDIRECT, "_d"),
+                ins("STA", DIRECT, "_b"),
+                ins("LDA", DIRECT, "_bp"),
+                ins("SUB", IMMEDIATE, frame_size),
+                ins("STA", DIRECT, "_sp"),
+                *moves,
+                ins("PUSH", DIRECT, "_a"),
+                ins("PUSH", DIRECT, "_b"),
+                ins("LDA", DIRECT, "_sp"),
+                ins("STA", DIRECT, "_bp"),
+                ins("BRA", DIRECT, "_c"),
+            ], None
         # CALL
         if op == "!":
             ret = next_ret()
             return [
-                "POP",
-                "STA &_d",
-                f"PUSH #{ret}",
-                f"PUSH &_bp",
-                f"LDA &_sp",
-                "STA &_bp",
-                f"BRA &_d",
-                f"{ret} NOP"
-            ]
-    
+                *take(cached),
+                ins("STA", DIRECT, "_d"),
+                ins("PUSH", IMMEDIATE, ret),
+                ins("PUSH", DIRECT, "_bp"),
+                ins("LDA", DIRECT, "_sp"),
+                ins("STA", DIRECT, "_bp"),
+                ins("BRA", DIRECT, "_d"),
+                ins("NOP", label=ret)
+            ], True
 
-    raise Exception(f"Unknown token type '{type}'.")
 
+    raise Exception(f"Unknown token type '{type(token).__name__}'.")
 
-def translate_sequence(tokens, args=None):
+
+def translate_sequence(tokens, scopes=(), memo=0):
+    # Returns the code for tokens, starting with the whole stack in memory,
+    # and whether the top of the stack is left in the accumulator.
     asm = []
-    for token in tokens:
-        asm += translate(token, args)
-    return asm
+    cached = False
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        if token.kind == NUM and following is not None and following.kind == OP and following.op == "*" and literal(token) <= SMALL_FACTOR:
+            if literal(token) != 1:
+                asm += take(cached) + multiply_by(literal(token))
+                cached = True
+            i += 2
+            continue
+        code, cached = translate(token, scopes, memo, cached)
+        asm += code
+        i += 1
+    return asm, cached
 
 
-def compile(tokens):
-    asm = translate_sequence(tokens)
+def compile(tokens, stdlib=None, memo=0, level=0):
+    # With memo > 0, pure functions of one argument keep their results for
+    # arguments below memo, counting hits and misses in _memo_hits and
+    # _memo_misses. level selects how much the peephole optimizer does.
+    globals = Globals()
+    resolve(tokens, globals)
+    globals.check()
+    tokens = prune_functions(fold_constants(tokens))
+    counters = []
+    if memo > 0:
+        mark_pure(tokens)
+        counters = [ins("DAT", label="_memo_hits"), ins("DAT", label="_memo_misses")]
+    # Memoized functions store their result on return, so they keep their
+    # frames.
+    mark_tail_calls(tokens, lambda func: memo > 0 and func.pure and len(func.args) == 1)
+    asm, cached = translate_sequence(tokens, (), memo)
+    # Whatever is left on the stack stays in memory for --dump.
+    asm += spill(cached)
 
-    stdlib = load_stdlib()
-    return "\n".join([
-        stdlib["macros"],
-        *asm,
-        "HLT",
-        stdlib["functions"],
-        stdlib["data"]
-    ])
\ No newline at end of file
+    if stdlib is None:
+        stdlib = load_stdlib()
+    asm = optimize([*asm, ins("HLT")], level)
+    return link(asm, stdlib, counters)
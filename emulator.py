@@ -1,15 +1,31 @@
 import re
-import numpy as np
-import time
+from array import array
+
+from channels import InputChannel, OutputChannel, console_input, console_output
 
 ws_expr = re.compile(r"[ \t]+")
 label_expr = re.compile(r"[a-zA-Z_][a-zA-Z0-9]*")
+macro_name_expr = re.compile(r"[A-Z][A-Z0-9]*")
 
 # OOOOPPMM AAAAAAAA AAAAAAAA AAAAAAAA
 # O = opcode / instruction
 # P = opcode - mode/misc
 # M = addressing mode
 # A = address
+#
+# Memory is a flat array('i') of 32-bit words. Data words are signed two's
+# complement integers: ADD, SUB and INP wrap the accumulator to 32 bits, so a
+# value stored with STA always fits its cell. Instruction words are kept as
+# the same 32-bit pattern reinterpreted as signed, so an opcode of 0b100000 or
+# above (INP, ITC, OUT, OTC) reads back as a negative number when used as data.
+
+WORD_BITS = 32
+WORD_SIGN = 1 << (WORD_BITS - 1)
+WORD_MASK = (1 << WORD_BITS) - 1
+
+
+def to_word(value):
+    return ((value + WORD_SIGN) & WORD_MASK) - WORD_SIGN
 
 opcodes = {
     "HLT": 0b0000_00,
@@ -37,58 +53,160 @@ address_modes = {
             "~": 0b10,
 }
 
+HLT = opcodes["HLT"]
+ADD = opcodes["ADD"]
+SUB = opcodes["SUB"]
+STA = opcodes["STA"]
+NOP = opcodes["NOP"]
+LDA = opcodes["LDA"]
+BRA = opcodes["BRA"]
+BRZ = opcodes["BRZ"]
+BRP = opcodes["BRP"]
+INP = opcodes["INP"]
+ITC = opcodes["ITC"]
+OUT = opcodes["OUT"]
+OTC = opcodes["OTC"]
 
-def strip_comments(lines):
-    return list(map(lambda l: l.split("--")[0].strip(), lines))
+valid_opcodes = set(opcodes.values())
 
-
-def filter_empty(strings):
-    return list(filter(lambda s: not re.match(r"^[ \t\r\n]*$", s), strings))
+IMMEDIATE = address_modes["IMMEDIATE"]
+DIRECT = address_modes["DIRECT"]
+INDIRECT = address_modes["INDIRECT"]
 
 
 def explode_line(line):
-    return tuple(filter(lambda s: len(s), map(lambda s: s.strip(), re.split(ws_expr, line))))
-
-
-def parse_macros(lines):
-    lines = lines[:]
-    i = 0
-    in_macro = False
-    start = 0
-    name = None
-    regions = [] 
-    while i < len(lines):
-        line = lines[i]
+    line = line.split("--")[0].strip()
+    if len(line) == 0:
+        return ()
+    return tuple(ws_expr.split(line))
+
+
+def split_source(code):
+    # Separates macro definitions from code in one pass over the source.
+    # Lines are kept as (line number, parts) pairs.
+    macros = {}
+    lines = []
+    name, start, body = None, None, None
+    for number, line in enumerate(code.split("\n"), 1):
         parts = explode_line(line)
+        if len(parts) == 0:
+            continue
         match(parts):
-            case ("macro", x) if type(x) is str and re.match(r"[A-Z][A-Z0-9]*", x):
-                if not in_macro:
-                    in_macro = True
-                    start = i
-                    name = x
-                else:
-                    raise Exception(f"Cannot define a macro at line {i} inside a macro starting at {start}.")
+            case ("macro", x) if macro_name_expr.match(x):
+                if name is not None:
+                    raise Exception(f"Cannot define a macro at line {number} inside a macro starting at {start}.")
+                name, start, body = x, number, []
+                continue
             case ("end",):
-                if in_macro:
-                    in_macro = False
-                    regions.append((name, start, i))
-                else:
-                    raise Exception(f"Unmatched macro end at line {i}.")
-        i += 1
-    
-    macros = {}
-    lines_to_delete = []
-    for name, start, end in regions:
-        macros[name] = lines[start+1:end]
-        lines_to_delete += list(range(start, end + 1))
-    
-    lines = [line for i, line in enumerate(lines) if i not in lines_to_delete]
+                if name is None:
+                    raise Exception(f"Unmatched macro end at line {number}.")
+                macros[name] = body
+                name = None
+                continue
+        if name is not None:
+            body.append(parts)
+        else:
+            lines.append((number, parts))
+
+    if name is not None:
+        raise Exception(f"Unterminated macro starting at line {start}.")
 
     return macros, lines
 
 
-def match_macro(line, macros):
-    parts = explode_line(line)
+class MacroTable():
+    # Each macro body is flattened into a template the first time the macro is
+    # used: nested macros are expanded in place, and every line records
+    # whether it mentions the "$" parameter so that an expansion only has to
+    # rewrite those lines.
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.templates = {}
+        self.parsed = {}
+        self.route = []
+
+    def __contains__(self, name):
+        return name in self.bodies
+
+    def template(self, name):
+        template = self.templates.get(name)
+        if template is not None:
+            return template
+
+        if name in self.route:
+            raise Exception("Detected cyclical macro definition: " + " > ".join(self.route + [name]))
+        self.route.append(name)
+
+        template = []
+        for parts in self.bodies[name]:
+            invocation = match_macro(parts, self)
+            if invocation is None:
+                template.append((parts, any("$" in part for part in parts)))
+            else:
+                label, inner, address = invocation
+                template += [(parts, any("$" in part for part in parts)) for parts in self.expand(label, inner, address)]
+
+        self.route.pop()
+        self.templates[name] = template
+        return template
+
+    def instructions(self, name):
+        # The template of a macro as (instruction, parameterised) pairs, or
+        # None if "$" is used other than as a whole operand. A parameterised
+        # instruction takes the mode and operand of the macro's invocation.
+        if name in self.parsed:
+            return self.parsed[name]
+        instructions = []
+        for parts, parameterised in self.template(name):
+            if parameterised:
+                op = match_op(parts)
+                if op is None or op[2] != "$":
+                    instructions = None
+                    break
+                instructions.append(((op[0], op[1], None, None), True))
+            else:
+                instruction = parse_instruction(parts)
+                if instruction is None:
+                    instructions = None
+                    break
+                instructions.append((instruction, False))
+        self.parsed[name] = instructions
+        return instructions
+
+    def expand_instruction(self, instruction):
+        # Expands an instruction whose mnemonic names a macro, without going
+        # through its source unless the macro needs it.
+        label, name, mode, operand = instruction
+        template = self.instructions(name)
+        if template is None:
+            return expand_line(tuple(render_instruction(instruction).split(" ")), self)
+        expanded = [(line[0], line[1], mode, operand) if parameterised else line for line, parameterised in template]
+        if label is not None:
+            if len(expanded) == 0:
+                raise empty_macro(name, label)
+            expanded[0] = (label, *expanded[0][1:])
+        return expanded
+
+    def expand(self, label, name, address):
+        if address is None:
+            address = ""
+        lines = []
+        for parts, parameterised in self.template(name):
+            if parameterised:
+                parts = tuple(part for part in (part.replace("$", address) for part in parts) if len(part))
+            lines.append(parts)
+        if label is not None:
+            if len(lines) == 0:
+                raise empty_macro(name, label)
+            lines[0] = (label, *lines[0])
+        return lines
+
+
+def empty_macro(name, label):
+    return Exception(f"Macro {name} expands to nothing, so it cannot carry the label '{label}'.")
+
+
+def match_macro(parts, macros):
     label, name, address = None, None, None
 
     match(parts):
@@ -106,70 +224,7 @@ def match_macro(line, macros):
     return label, name, address
 
 
-def expand_macro(macros, name, address="$", route=None):
-    if route is None:
-        route = []
-    route.append(name)
-
-    if address is None:
-        address = ""
-
-    macro = macros[name][:]
-
-    i = 0
-    while i < len(macro):
-        line = macro[i]
-        match = match_macro(line, macros)
-        if match is not None:
-            l2, n2, a2 = match
-            if n2 in route:
-                raise Exception("Detected cyclical macro definition: " + " > ".join(route + [n2]))
-            expanded = expand_macro(macros, n2, a2, route)
-            del macro[i]
-            for j, line in enumerate(expanded):
-                macro.insert(i + j, line)
-            if l2 is not None:
-                line[i] = l2 + "\t" + line[i]
-            i += len(expanded)
-        else:
-            i += 1
-    
-    for i, line in enumerate(macro):
-        macro[i] = line.replace("$", address)
-
-    return macro
-
-def expand_macros(macros):
-    macros = {**macros}
-    for name in macros:
-        macros[name] = expand_macro(macros, name)
-    return macros
-
-
-def insert_macros(lines, macros):
-    lines = list(lines)[:]
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        match = match_macro(line, macros)
-        if match is None:
-            i += 1
-            continue
-        del lines[i]
-        label, name, address = match
-        if address is None:
-            address = ""
-        macro = macros[name]
-        for j, line in enumerate(macro):
-            lines.insert(i + j, line.replace("$", address))
-        if label is not None:
-            lines[i] = label + "\t" + lines[i]
-        i += len(macro)
-    return lines
-
-
-def match_op(line):
-    parts = explode_line(line)
+def match_op(parts):
     label, mnemonic, address = None, None, None
 
     match(parts):
@@ -187,35 +242,11 @@ def match_op(line):
     return label, mnemonic, address
 
 
-def parse_ops(lines):
-    labels = {}
-    operations = []
-    for i, line in enumerate(lines):
-        line = line.split("--")[0].strip()
-
-        if len(line) == 0:
-            continue
-
-        op = match_op(line)
-        if op is None:
-            raise Exception(f"Malformed instruction at line {i}:\n  {line}")
-
-        label, mnemonic, address = op
-
-        if label is not None:
-            if re.match(label_expr, label):
-                labels[label] = len(operations)
-            else:
-                raise Exception(f"Invalid label '{label}'.")
-
-        operations.append((opcodes[mnemonic], address))
-
-    return labels, operations
-
-
-def resolve_address(address, labels):
+def parse_address(address):
+    # Returns (mode, address, label). When the operand names a label, the
+    # address is left as 0 for the caller to fix up once all labels are known.
     if address is None:
-        return (0, 0)
+        return (0, 0, None)
 
     mode = 0x00
 
@@ -223,135 +254,504 @@ def resolve_address(address, labels):
         mode = address_modes[address[0]]
         address = address[1:]
 
-    if re.match(label_expr, address):
-        if address in labels:
-            address = labels[address]
-        else:
-            raise Exception(f"Unknown label '{address}'.")
+    if label_expr.match(address):
+        return mode, 0, address
 
     try:
         address = int(address)
     except:
         raise Exception(f"Invalid address '{address}'.")
 
-    return mode, address
-    
-
-def resolve_addresses(operations, labels):
-    resolved = []
-    for op in operations:
-        opcode, address = op
-        mode, address = resolve_address(address, labels)
-        resolved.append((opcode, mode, address))
-    return resolved
+    return mode, address, None
 
 
 def flatten(operations):
-    return list(map(lambda op: np.uint32((((op[0] << 2) | op[1]) << 24) | op[2]), operations))
+    return array("i", map(lambda op: to_word((((op[0] << 2) | op[1]) << 24) | op[2]), operations))
+
+
+def parse_instruction(parts):
+    # Returns the (label, mnemonic, mode, operand) instruction for the parts
+    # of a line, or None if they aren't one. operand is an address, the name
+    # of a label to be fixed up, or None when there is no operand.
+    op = match_op(parts)
+    if op is None:
+        return None
+
+    label, mnemonic, address = op
+
+    if label is not None and not label_expr.match(label):
+        raise Exception(f"Invalid label '{label}'.")
+
+    if address is None:
+        return (label, mnemonic, IMMEDIATE, None)
+    mode, address, target = parse_address(address)
+    return (label, mnemonic, mode, address if target is None else target)
+
+
+def expand_line(parts, macros):
+    # Returns the instructions one line of source assembles to, with macros
+    # expanded, or None if it is malformed.
+    invocation = match_macro(parts, macros)
+    expanded = (parts,) if invocation is None else macros.expand(*invocation)
+    instructions = []
+    for parts in expanded:
+        instruction = parse_instruction(parts)
+        if instruction is None:
+            return None
+        instructions.append(instruction)
+    return instructions
+
+
+def render_instruction(instruction):
+    # The line of LMC source for an instruction. Immediate operands are
+    # written without "#" after a branch or DAT.
+    label, mnemonic, mode, operand = instruction
+    parts = [mnemonic] if label is None else [label, mnemonic]
+    if operand is not None:
+        prefix = {DIRECT: "&", INDIRECT: "~"}.get(mode, "" if mnemonic in ["BRA", "BRZ", "BRP", "DAT"] else "#")
+        parts.append(f"{prefix}{operand}")
+    return " ".join(parts)
+
+
+def parse_source(code):
+    bodies, lines = split_source(code)
+    macros = MacroTable(bodies)
+
+    instructions = []
+    for number, parts in lines:
+        expanded = expand_line(parts, macros)
+        if expanded is None:
+            raise Exception(f"Malformed instruction at line {number}:\n  {' '.join(parts)}")
+        instructions += expanded
+    return instructions
+
+
+def assemble_object(code):
+    # code is LMC source, or a list of instructions as parse_source returns
+    # them, which is what the compiler produces.
+    instructions = parse_source(code) if isinstance(code, str) else code
+
+    labels = {}
+    for index, (label, _, _, _) in enumerate(instructions):
+        if label is not None:
+            labels[label] = index
+
+    operations = []
+    for _, mnemonic, mode, address in instructions:
+        if address is None:
+            address = 0
+        elif isinstance(address, str):
+            if address not in labels:
+                raise Exception(f"Unknown label '{address}'.")
+            address = labels[address]
+        operations.append((opcodes[mnemonic], mode, address))
+
+    return flatten(operations), labels
 
 
 def assemble(code):
-    lines = filter_empty(code.split("\n"))
-    lines = strip_comments(lines)
-    lines = filter_empty(lines)
-    macros, lines = parse_macros(lines)
-    macros = expand_macros(macros)
-    lines = insert_macros(lines, macros)
-    # print("\n".join(map(lambda l: f"{l[0]}\t{l[1]}", enumerate(lines))))
-    labels, operations = parse_ops(lines)
-    operations = resolve_addresses(operations, labels)
-    # print("\n".join(f"{i} {z[0]} =>\t\t{str(z[1])}" for i, z in enumerate(zip(lines, operations))))
-    instructions = flatten(operations)
+    instructions, _ = assemble_object(code)
     return instructions
 
 
-def read(memory, address, mode):
-    if mode == address_modes["IMMEDIATE"]:
-        return np.int16(address)
-    if mode == address_modes["DIRECT"]:
-        return memory[address]
-    if mode == address_modes["INDIRECT"]:
-        next = memory[address]
-        return memory[next]
-    raise Exception(f"Invalid address mode {mode}.")
-
-
-def write(memory, address, mode, value):
-    if mode == address_modes["IMMEDIATE"]:
-        raise Exception("Cannot write to an immediate address.")
-    elif mode == address_modes["DIRECT"]:
-        memory[address] = value
-    elif mode == address_modes["INDIRECT"]:
-        next = memory[address]
-        memory[next] = value
-    else:
+def decode(word):
+    word = word & WORD_MASK
+    opcode = word >> 26
+    mode = (word >> 24) & 0b11
+    address = word & 0xff_ff_ff
+    if opcode not in valid_opcodes:
+        raise Exception("Invalid instruction {0:06b}_{1:02b} {2:08b}. Unrecognised opcode.".format(opcode, mode, address))
+    if mode == 0b11:
         raise Exception(f"Invalid address mode {mode}.")
+    return opcode, mode, address
+
+
+def operand(mode, address):
+    if mode == IMMEDIATE:
+        return str(address)
+    if mode == DIRECT:
+        return f"memory[{address}]"
+    return f"memory[memory[{address}]]"
+
+
+class BlockCompiler():
+    # Tiered execution: a basic block runs from a branch target up to and
+    # including the next BRA/BRZ/BRP. Once a block has been entered
+    # hot_threshold times it is translated to a Python function that keeps the
+    # accumulator in a local and indexes memory directly. Blocks stop short of
+    # HLT and INP/ITC, which are left to the interpreter.
+    hot_threshold = 16
+
+    def __init__(self, memory, decoded, code_size, stdout):
+        self.memory = memory
+        self.stdout = stdout
+        self.decoded = decoded
+        self.code_size = code_size
+        self.blocks = {}
+        self.extents = {}
+        self.counts = {}
+        self.owners = {}
+
+    def run(self, pc, acc):
+        blocks = self.blocks
+        memory = self.memory
+        while True:
+            block = blocks.get(pc)
+            if block is None:
+                if pc >= self.code_size:
+                    return pc, acc
+                count = self.counts.get(pc, 0) + 1
+                self.counts[pc] = count
+                if count < self.hot_threshold:
+                    return pc, acc
+                block = self.compile(pc)
+                if block is None:
+                    return pc, acc
+            pc, acc = block(memory, acc)
+
+    def scan(self, start):
+        ops = []
+        pc = start
+        while pc < self.code_size:
+            op = self.decoded[pc]
+            if op is None:
+                op = self.decoded[pc] = decode(self.memory[pc])
+            opcode = op[0]
+            if opcode in (HLT, INP, ITC):
+                break
+            ops.append(op)
+            pc += 1
+            if opcode in (BRA, BRZ, BRP):
+                break
+        return ops
+
+    def compile(self, start):
+        ops = self.scan(start)
+        if len(ops) == 0:
+            self.counts[start] = -1 << 32
+            return None
 
+        end = start + len(ops)
+        lines = [f"def block_{start}(memory, acc, decoded=decoded, owners=owners, invalidate=invalidate, output=output, output_char=output_char):"]
+        for pc, (opcode, mode, address) in enumerate(ops, start):
+            next = pc + 1
+            if opcode == LDA:
+                lines.append(f"    acc = {operand(mode, address)}")
+            elif opcode == ADD:
+                lines.append(f"    acc = ((acc + {operand(mode, address)} + {WORD_SIGN}) & {WORD_MASK}) - {WORD_SIGN}")
+            elif opcode == SUB:
+                lines.append(f"    acc = ((acc - {operand(mode, address)} + {WORD_SIGN}) & {WORD_MASK}) - {WORD_SIGN}")
+            elif opcode == STA:
+                if mode == IMMEDIATE:
+                    raise Exception("Cannot write to an immediate address.")
+                if mode == DIRECT:
+                    lines.append(f"    memory[{address}] = acc")
+                    if address < self.code_size:
+                        lines += [
+                            f"    decoded[{address}] = None",
+                            f"    if {address} in owners:",
+                            f"        invalidate({address})",
+                            f"        return {next}, acc",
+                        ]
+                else:
+                    lines += [
+                        f"    t = memory[{address}]",
+                        f"    memory[t] = acc",
+                        f"    if t < {self.code_size}:",
+                        f"        decoded[t] = None",
+                        f"        if t in owners:",
+                        f"            invalidate(t)",
+                        f"            return {next}, acc",
+                    ]
+            elif opcode == OUT:
+                lines.append("    output(acc)")
+            elif opcode == OTC:
+                lines.append("    output_char(acc)")
+            elif opcode == BRA:
+                lines.append(f"    return {operand(mode, address)}, acc")
+            elif opcode == BRZ:
+                lines.append(f"    if acc == 0: return {operand(mode, address)}, acc")
+            elif opcode == BRP:
+                lines.append(f"    if acc > 0: return {operand(mode, address)}, acc")
+        if ops[-1][0] != BRA:
+            lines.append(f"    return {end}, acc")
+
+        namespace = {
+            "decoded": self.decoded,
+            "owners": self.owners,
+            "invalidate": self.invalidate,
+            "output": self.stdout.write_int,
+            "output_char": self.stdout.write_char,
+        }
+        exec(compile("\n".join(lines), f"<block {start}>", "exec"), namespace)
+        block = namespace[f"block_{start}"]
+
+        self.blocks[start] = block
+        self.extents[start] = end
+        for pc in range(start, end):
+            self.owners.setdefault(pc, set()).add(start)
+        return block
+
+    def invalidate(self, address):
+        for start in list(self.owners.get(address, ())):
+            end = self.extents.pop(start)
+            del self.blocks[start]
+            self.counts[start] = 0
+            for pc in range(start, end):
+                owners = self.owners[pc]
+                owners.discard(start)
+                if len(owners) == 0:
+                    del self.owners[pc]
+
+
+def execute(memory, code_size=None, jit=False, stdin=None, stdout=None):
+    # Each cell of the code region is decoded once into (opcode, mode, address).
+    # A store into the code region drops the cached decoding of that cell, so
+    # self-modifying code is re-decoded the next time it is fetched.
+    if code_size is None:
+        code_size = len(memory)
+    if stdout is None:
+        stdout = console_output()
+    if stdin is None:
+        stdin = console_input(stdout)
+    read_int, read_char = stdin.read_int, stdin.read_char
+    write_int, write_char = stdout.write_int, stdout.write_char
+
+    decoded = [None] * code_size
+    jit = BlockCompiler(memory, decoded, code_size, stdout) if jit else None
 
-def execute(memory, stack_base):
     pc = 0
     acc = 0
+    memsize = len(memory)
 
-    while pc < len(memory):
+    while pc < memsize:
         ci = pc
-        op = np.uint32(memory[ci])
-        opcode = int(op >> 26)
-        mode = (op >> 24) & 0b11
-        address = np.uint32(op & 0xff_ff_ff)
-        # print("{}: {:06b}_{:02b} {:08b}".format(pc, opcode, mode, address))
-        if opcode == opcodes["HLT"]:
-            break
-        elif opcode == opcodes["ADD"]:
-            acc += read(memory, address, mode)
-            pc = ci + 1
-        elif opcode == opcodes["SUB"]:
-            acc -= read(memory, address, mode)
-            pc = ci + 1
-        elif opcode == opcodes["STA"]:
-            write(memory, address, mode, acc)
-            pc = ci + 1
-        elif opcode == opcodes["NOP"]:
-            pc = ci + 1
-        elif opcode == opcodes["LDA"]:
-            acc = read(memory, address, mode)
-            pc = ci + 1
-        elif opcode == opcodes["BRA"]:
-            pc = read(memory, address, mode)
-        elif opcode == opcodes["BRZ"]:
-            if acc == 0:
-                pc = read(memory, address, mode)
+        if ci < code_size:
+            op = decoded[ci]
+            if op is None:
+                op = decoded[ci] = decode(memory[ci])
+        else:
+            op = decode(memory[ci])
+        opcode, mode, address = op
+        pc = ci + 1
+        if opcode == LDA:
+            if mode == DIRECT:
+                acc = memory[address]
+            elif mode == IMMEDIATE:
+                acc = address
             else:
-                pc = ci + 1
-        elif opcode == opcodes["BRP"]:
-            if acc > 0:
-                pc = read(memory, address, mode)
+                acc = memory[memory[address]]
+        elif opcode == STA:
+            if mode == DIRECT:
+                pass
+            elif mode == INDIRECT:
+                address = memory[address]
             else:
-                pc = ci + 1
-        elif opcode == opcodes["INP"]:
-            acc = np.int16(input(" > "))
-            pc = ci + 1
-        elif opcode == opcodes["ITC"]:
-            raise NotImplementedError()
-        elif opcode == opcodes["OUT"]:
-            print(acc)
-            pc = ci + 1
-        elif opcode == opcodes["OTC"]:
-            raise NotImplementedError()
-        else:
-            raise Exception("Invalid instruction {0:06b}_{1:02b} {2:08b}. Unrecognised opcode.".format(opcode, mode, address))
-
-        # print("{0:06b}_{1:02b} {2:08b}\t\t => pc: {3} > {4}\tacc: {5}\t{6}".format(opcode, mode, address, ci, pc, acc, memory[stack_base:]))
-        # time.sleep(0.1)
-                
-
-def emulate(source, memsize=None):
-    object = assemble(source)
-    stack_base = len(object) - 1
+                raise Exception("Cannot write to an immediate address.")
+            memory[address] = acc
+            if address < code_size:
+                decoded[address] = None
+                if jit is not None and address in jit.owners:
+                    jit.invalidate(address)
+        elif opcode == ADD:
+            if mode == DIRECT:
+                acc = ((acc + memory[address] + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+            elif mode == IMMEDIATE:
+                acc = ((acc + address + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+            else:
+                acc = ((acc + memory[memory[address]] + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+        elif opcode == SUB:
+            if mode == DIRECT:
+                acc = ((acc - memory[address] + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+            elif mode == IMMEDIATE:
+                acc = ((acc - address + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+            else:
+                acc = ((acc - memory[memory[address]] + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+        elif opcode == BRA or (opcode == BRZ and acc == 0) or (opcode == BRP and acc > 0):
+            if mode == IMMEDIATE:
+                pc = address
+            elif mode == DIRECT:
+                pc = memory[address]
+            else:
+                pc = memory[memory[address]]
+            if jit is not None:
+                pc, acc = jit.run(pc, acc)
+        elif opcode == BRZ or opcode == BRP:
+            if jit is not None:
+                pc, acc = jit.run(pc, acc)
+        elif opcode == NOP:
+            pass
+        elif opcode == HLT:
+            break
+        elif opcode == INP:
+            acc = to_word(read_int())
+        elif opcode == ITC:
+            acc = read_char()
+        elif opcode == OUT:
+            write_int(acc)
+        elif opcode == OTC:
+            write_char(acc)
+
+
+def emulate(source, memsize=None, jit=False, stdin=None, stdout=None):
+    # source is either LMC code, a list of instructions or an already
+    # assembled object.
+    object = source if isinstance(source, array) else assemble(source)
     if memsize is None:
         memsize = len(object) + 256
-    memory = [np.int16(0)] * memsize
+    memory = array("i", [0]) * memsize
     memory[:len(object)] = object
 
-    execute(memory, stack_base)
+    if stdout is None:
+        stdout = console_output()
+    try:
+        execute(memory, len(object), jit, stdin, stdout)
+    finally:
+        stdout.flush()
+
+    return memory
+
+def emulate_batch(source, inputs, memsize=None):
+    # Runs one program against many input sets in lockstep. Each input set is
+    # a lane with its own pc, accumulator and copy of memory. On every step
+    # the running lanes at the lowest pc execute that instruction together,
+    # with one vectorised operation. Lanes that branch apart are stepped in
+    # turn, and the ones behind catch up with the others where their paths
+    # meet again.
+    #
+    # While every running lane is at the same pc, which is the usual case,
+    # that pc is kept in a Python int instead of the pc array. Instructions
+    # are decoded once from the assembled object, and only read from every
+    # lane's memory once some lane has stored to their cell.
+    #
+    # source is either LMC code, a list of instructions or an already
+    # assembled object, as for emulate. Each input set is either a string of
+    # text or an iterable of values. Returns the output of each lane as the
+    # text emulate would have written, and the memory of every lane.
+    import numpy as np
+
+    object = source if isinstance(source, array) else assemble(source)
+    if memsize is None:
+        memsize = len(object) + 256
+    code_size = len(object)
+
+    lanes = len(inputs)
+    # Memory is indexed by address first, so that the lanes' copies of a
+    # cell are next to each other.
+    memory = np.zeros((memsize, lanes), dtype=np.int32)
+    memory[:code_size] = np.array(object, dtype=np.int32)[:, None]
+    pc = np.zeros(lanes, dtype=np.int64)
+    acc = np.zeros(lanes, dtype=np.int32)
+    running = np.ones(lanes, dtype=bool)
+    rows = np.arange(lanes)
+
+    stdin = [InputChannel.from_text(values) if isinstance(values, str) else InputChannel.from_values(values) for values in inputs]
+    stdout = [OutputChannel() for _ in range(lanes)]
+    decoded = [None] * code_size
+    written = [False] * code_size
+    ops = {}
+
+    live = rows
+    together = True
+    at = 0
+    while len(live) > 0:
+        # lane selects the lanes that run this step, as a slice when it is
+        # all of them, and index selects the same lanes as an index array.
+        if not together:
+            pcs = pc[live]
+            at = int(pcs.min())
+            together = pcs.max() == at
+        if at >= memsize:
+            running[live[pc[live] >= memsize] if not together else live] = False
+            live = np.flatnonzero(running)
+            together = False
+            continue
+        if not together:
+            lane = index = live[pcs == at]
+        elif len(live) == lanes:
+            lane, index = slice(None), rows
+        else:
+            lane = index = live
+
+        if 0 <= at < code_size and not written[at]:
+            op = decoded[at]
+            if op is None:
+                op = decoded[at] = decode(object[at])
+        else:
+            words = memory[at, lane]
+            word = int(words[0])
+            if (words != word).any():
+                # The lanes have written different instructions to this
+                # cell, so only those that agree with the first run now.
+                if together:
+                    pc[live] = at
+                    together = False
+                lane = index = index[words == word]
+            op = ops.get(word)
+            if op is None:
+                op = ops[word] = decode(word)
+        opcode, mode, address = op
+
+        if mode == IMMEDIATE:
+            value = address
+        elif mode == DIRECT:
+            value = memory[address, lane]
+        else:
+            value = memory[memory[address, index], index]
+
+        target = at + 1
+        if opcode == LDA:
+            acc[lane] = value
+        elif opcode == ADD:
+            acc[lane] += value
+        elif opcode == SUB:
+            acc[lane] -= value
+        elif opcode == STA:
+            if mode == IMMEDIATE:
+                raise Exception("Cannot write to an immediate address.")
+            if mode == DIRECT:
+                memory[address, lane] = acc[lane]
+                if address < code_size:
+                    written[address] = True
+            else:
+                targets = memory[address, index]
+                memory[targets, index] = acc[index]
+                if targets.min() < code_size:
+                    for cell in set(targets[targets < code_size].tolist()):
+                        written[cell] = True
+        elif opcode == BRA:
+            target = value
+        elif opcode == BRZ or opcode == BRP:
+            taken = acc[lane] == 0 if opcode == BRZ else acc[lane] > 0
+            if taken.all():
+                target = value
+            elif taken.any():
+                target = np.where(taken, value, at + 1)
+        elif opcode == HLT:
+            running[lane] = False
+            live = np.flatnonzero(running)
+            continue
+        elif opcode == INP:
+            for i in index.tolist():
+                acc[i] = to_word(stdin[i].read_int())
+        elif opcode == ITC:
+            for i in index.tolist():
+                acc[i] = stdin[i].read_char()
+        elif opcode == OUT:
+            for i, value in zip(index.tolist(), acc[index].tolist()):
+                stdout[i].write_int(value)
+        elif opcode == OTC:
+            for i, value in zip(index.tolist(), acc[index].tolist()):
+                stdout[i].write_char(value)
+
+        if not isinstance(target, int) and (target == target[0]).all():
+            target = int(target[0])
+        if not together:
+            pc[lane] = target
+        elif isinstance(target, int):
+            at = target
+        else:
+            pc[lane] = target
+            together = False
 
-    return memory
\ No newline at end of file
+    return [channel.getvalue() for channel in stdout], memory.T
@@ -0,0 +1,94 @@
+from collections import deque
+
+from nodes import NUM, OP, REFERENCE, CONSTANT, IF, IF_ELSE, FUNCTION, Num, If, IfElse, Function
+from purity import walk
+
+# Constant folding for the compiler. Arithmetic, '=' and '~' on values known
+# at compile time are worked out ahead of time, a '?' on a known condition
+# keeps only the branch that would run, and a name bound once with 'is'
+# directly at the top level is replaced by its value wherever it is read
+# after the binding.
+#
+# Values follow the compiled code rather than the interpreter: a literal is
+# pushed modulo 255, so that is the value it folds as, and a folded result is
+# pushed exactly as it is (Num.exact). Results that can't be pushed as an
+# immediate, such as negative numbers, and divisions by zero are left to run.
+# Runs after resolver.resolve.
+
+MAX_IMMEDIATE = (1 << 24) - 1
+
+binary_ops = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": lambda a, b: a // b if b != 0 else None,
+    "%": lambda a, b: a % b if b != 0 else None,
+    "=": lambda a, b: 1 if a == b else 0,
+}
+
+
+def value(token):
+    if token.kind != NUM:
+        return None
+    return token.value if token.exact else token.value % 255
+
+
+def exact(result):
+    if result is None or result < 0 or result > MAX_IMMEDIATE:
+        return None
+    num = Num(result)
+    num.exact = True
+    return num
+
+
+def fold_block(tokens, known, counts, top_level=False):
+    # known maps names to the values they are bound to. It is only added to
+    # at the top level, where code runs once and in order.
+    out = []
+    pending = deque(tokens)
+    while len(pending) > 0:
+        token = pending.popleft()
+        kind = token.kind
+        folded = None
+        if kind == OP and token.op in binary_ops and len(out) >= 2:
+            a, b = value(out[-2]), value(out[-1])
+            if a is not None and b is not None:
+                folded = exact(binary_ops[token.op](a, b))
+                if folded is not None:
+                    del out[-2:]
+        elif kind == OP and token.op == "~" and len(out) >= 1:
+            a = value(out[-1])
+            if a is not None:
+                folded = exact(1 if a == 0 else 0)
+                del out[-1:]
+        elif kind == REFERENCE and token.depth is None and token.name in known:
+            folded = exact(known[token.name])
+        elif kind == CONSTANT:
+            if top_level and counts.get(token.name) == 1 and len(out) >= 1 and value(out[-1]) is not None:
+                known[token.name] = value(out[-1])
+        elif kind in [IF, IF_ELSE]:
+            condition = value(out[-1]) if len(out) >= 1 else None
+            if condition is not None:
+                # Only the branch that runs is kept, in place of the if.
+                del out[-1:]
+                if condition != 0:
+                    pending.extendleft(reversed(token.block))
+                elif kind == IF_ELSE:
+                    pending.extendleft(reversed(token.else_block))
+                continue
+            if kind == IF:
+                folded = If(fold_block(token.block, dict(known), counts))
+            else:
+                folded = IfElse(fold_block(token.block, dict(known), counts), fold_block(token.else_block, dict(known), counts))
+        elif kind == FUNCTION:
+            folded = Function(token.args, fold_block(token.block, dict(known), counts))
+        out.append(token if folded is None else folded)
+    return out
+
+
+def fold_constants(tokens):
+    counts = {}
+    for token, _ in walk(tokens):
+        if token.kind == CONSTANT:
+            counts[token.name] = counts.get(token.name, 0) + 1
+    return fold_block(tokens, {}, counts, True)
@@ -1,142 +1,353 @@
-from collections import deque
-
-class SymbolTable():
-    def __init__(self):
-        self.scopes = [{}]
-    
-    def push_scope(self, symbols=None):
-        if symbols is None:
-            symbols = {}
-        self.scopes.append(symbols)
-    
-    def pop_scope(self):
-        self.scopes.pop()
-        if len(self.scopes) == 0:
-            self.scopes.append({})
-
-    def get(self, key):
-        for scope in reversed(self.scopes):
-            if key in scope:
-                return scope[key]
-    
-    def set(self, key, value):
-        self.scopes[-1][key] = value
-    
-    def __getitem__(self, key):
-        return self.get(key)
-    
-    def __setitem__(self, key, value):
-        return self.set(key, value)
-
-    def __contains__(self, key):
-        return any(key in scope for scope in reversed(self.scopes))
-
-
-def execute(ip, token, stack, queue, symbols, funcs):
-    # print(token, stack, "=> ", end="")
-    if token["type"] == "num":
-        stack.append(token["value"])
-    elif token["type"] == "function":
-        func = token["value"]
-        funcs.append(func)
-        addr = len(funcs) - 1
-        stack.append(addr)
-    elif token["type"] == "return":
-        return_value = stack.pop()
-        stack.pop() # Pop the base pointer for parity
-        return_addr = stack.pop()
-        for i in range(token["arg_count"]):
-            stack.pop()
-        ip = return_addr
-        stack.append(return_value)
-        symbols.pop_scope()
-    elif token["type"] == "constant":
-        name = token["value"]
-        value = stack.pop()
-        symbols[name] = value
-    elif token["type"] == "reference":
-        name = token["value"]
-        if name in symbols:
-            stack.append(symbols[name])
-        else:
-            raise Exception(f"Label '{name}' is undefined.")
-    elif token["type"] == "if":
-        condition = stack.pop()
-        if condition:
-            queue.extendleft(reversed(token["value"]))
-    elif token["type"] == "if-else":
-        condition = stack.pop()
-        if condition:
-            queue.extendleft(reversed(token["value"][0]))
+from collections import OrderedDict
+
+from channels import console_output
+from nodes import NUM, OP, REFERENCE, CONSTANT, IF, IF_ELSE, FUNCTION
+from purity import mark_pure
+from resolver import Globals, linked_functions, reads_outer, resolve
+from tailcall import mark_tail_calls
+
+
+# The interpreter lowers the token tree to a flat list of bytecode before
+# running it, so that branches and calls are jumps rather than copies of the
+# block being entered. Each instruction takes two slots in the list: the
+# opcode and its argument (None when it has none).
+PUSH = 0
+LOAD_ARG = 1
+LOAD_OUTER = 2
+LOAD_GLOBAL = 3
+STORE_GLOBAL = 4
+CALL = 5
+TAIL_CALL = 6
+RETURN = 7
+JUMP = 8
+JUMP_IF_ZERO = 9
+FUNC = 10
+ADD = 11
+SUB = 12
+MUL = 13
+DIV = 14
+MOD = 15
+EQ = 16
+NOT = 17
+PRINT = 18
+VOID = 19
+PEEK = 20
+ENTER = 21
+
+op_codes = {
+    "+": ADD,
+    "-": SUB,
+    "*": MUL,
+    "/": DIV,
+    "%": MOD,
+    "=": EQ,
+    "~": NOT,
+    ".": PRINT,
+    "void": VOID,
+    "@": PEEK,
+    "!": CALL,
+}
+
+
+class Routine():
+    # One per function definition site, created when the function is lowered.
+    # Running the definition pushes the routine's index in the function
+    # table, so a function literal in a loop or a recursive body does not add
+    # a new entry each time. It also sets link to the frame of the enclosing
+    # call, through which the function reads that call's arguments. children
+    # are the routines defined directly in this one that have links. Frames
+    # that have returned are kept on the routine's free list for its next
+    # call.
+    __slots__ = ("index", "entry", "end", "arg_count", "free", "cache", "link", "children")
+
+    def __init__(self, index, entry, arg_count, cache=None):
+        self.index = index
+        self.entry = entry
+        self.end = None
+        self.arg_count = arg_count
+        self.free = []
+        self.cache = cache
+        self.link = None
+        self.children = []
+
+
+class Frame():
+    # base is the position of the call's saved base pointer on the stack,
+    # just above its return address. saved holds the links of the routine's
+    # children from before the call, to be put back when it returns. The
+    # stack has a cell for each of them above the base pointer, as compiled
+    # code does.
+    __slots__ = ("routine", "args", "base", "saved")
+
+    def __init__(self, routine):
+        self.routine = routine
+        self.args = [None] * routine.arg_count
+        self.base = None
+        self.saved = None
+
+
+class CallCache():
+    # A bounded LRU of one pure function's results, keyed by its arguments.
+    __slots__ = ("entries", "max_size", "hits", "misses")
+
+    def __init__(self, max_size):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+DEFAULT_MEMO_SIZE = 1024
+
+
+class Memo():
+    # Opts pure functions into memoization, with up to max_size results
+    # cached for each of them.
+    def __init__(self, max_size=DEFAULT_MEMO_SIZE):
+        self.max_size = max_size
+        self.caches = []
+
+    def cache(self):
+        cache = CallCache(self.max_size)
+        self.caches.append(cache)
+        return cache
+
+    @property
+    def hits(self):
+        return sum(cache.hits for cache in self.caches)
+
+    @property
+    def misses(self):
+        return sum(cache.misses for cache in self.caches)
+
+
+def lower(tokens, code, funcs, memo=None, routines=()):
+    # routines holds the Routine of each enclosing function, innermost last.
+    for token in tokens:
+        kind = token.kind
+        if kind == NUM:
+            code += (PUSH, token.value)
+        elif kind == OP:
+            if token.op not in op_codes:
+                raise Exception(f"Unrecognised operator '{token.op}'.")
+            code += (TAIL_CALL if token.tail else op_codes[token.op], None)
+        elif kind == REFERENCE:
+            if token.depth is None:
+                code += (LOAD_GLOBAL, token.slot)
+            elif token.depth == 0:
+                code += (LOAD_ARG, token.slot)
+            else:
+                # The function depth - 1 levels out links to the frame of
+                # the call it was defined in, which holds the argument.
+                code += (LOAD_OUTER, (routines[-token.depth], token.slot, token.name))
+        elif kind == CONSTANT:
+            code += (STORE_GLOBAL, token.slot)
+        elif kind == IF:
+            code += (JUMP_IF_ZERO, None)
+            skip = len(code) - 1
+            lower(token.block, code, funcs, memo, routines)
+            code[skip] = len(code)
+        elif kind == IF_ELSE:
+            code += (JUMP_IF_ZERO, None)
+            skip = len(code) - 1
+            lower(token.block, code, funcs, memo, routines)
+            code += (JUMP, None)
+            end = len(code) - 1
+            code[skip] = len(code)
+            lower(token.else_block, code, funcs, memo, routines)
+            code[end] = len(code)
+        elif kind == FUNCTION:
+            cache = memo.cache() if memo is not None and token.pure else None
+            routine = Routine(len(funcs), len(code) + 2, len(token.args), cache)
+            funcs.append(routine)
+            if len(routines) > 0 and reads_outer(token.block, 1):
+                routines[-1].children.append(routine)
+            code += (FUNC, routine)
+            if len(linked_functions(token.block)) > 0:
+                code += (ENTER, routine)
+            lower(token.block, code, funcs, memo, (*routines, routine))
+            code += (RETURN, routine.arg_count)
+            routine.end = len(code)
         else:
-            queue.extendleft(reversed(token["value"][1]))
-    elif token["type"] == "op":
-        op = token["value"]
-        if op == "@":
-            a = stack.pop()
-            stack.append(stack[-(a+1)])
-        elif op == "void":
-            stack.pop()
-        elif op == "!":
-            addr = stack.pop()
-            func = funcs[addr]
-            args = { name: stack[-(i+1)] for i, name in enumerate(reversed(func["args"])) }
-            symbols.push_scope(args)
-            stack.append(ip)
-            stack.append(len(stack))
-            queue.extendleft(reversed([*func["block"], { "type": "return", "arg_count": len(func["args"]) }]))
-        elif op == "+":
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(a + b)
-        elif op == "-":
-            b = stack.pop()
-            a = stack.pop()
-            stack.append(a - b)
-        elif op == "*":
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(a * b)
-        elif op == "/":
-            b = stack.pop()
-            a = stack.pop()
-            stack.append(a // b)
-        elif op == "%":
-            b = stack.pop()
-            a = stack.pop()
-            stack.append(a % b)
-        elif op == "=":
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(1 if a == b else 0)
-        elif op == "~":
-            a = stack.pop()
-            stack.append(1 if a == 0 else 0)
-        elif op == ".":
-            print(stack.pop())
+            raise Exception(f"Unknown token type '{type(token).__name__}'.")
+    return code
+
+
+def run(code, pc, stack, frames, globals, funcs, stdout):
+    # frames holds the Frame of each active call, innermost last.
+    push = stack.append
+    pop = stack.pop
+    values = globals.values
+    end = len(code)
+    while pc < end:
+        op = code[pc]
+        arg = code[pc + 1]
+        pc += 2
+        if op == PUSH:
+            push(arg)
+        elif op == LOAD_ARG:
+            push(frames[-1].args[arg])
+        elif op == LOAD_GLOBAL:
+            value = values[arg]
+            if value is None:
+                raise Exception(f"Label '{globals.names[arg]}' is undefined.")
+            push(value)
+        elif op == CALL or op == TAIL_CALL:
+            routine = funcs[pop()]
+            if op == TAIL_CALL:
+                # The callee's arguments replace the caller's, and it returns
+                # straight to the caller's return address. Only when they are
+                # all that is left above the caller's frame, and neither
+                # function stores its result on return.
+                frame = frames[-1]
+                base = frame.base
+                if len(stack) - base - 1 == routine.arg_count and routine.cache is None and frame.routine.cache is None:
+                    ret = stack[base - 1]
+                    del stack[base - 1 - frame.routine.arg_count:base + 1]
+                    frame.routine.free.append(frame)
+                    frame = routine.free.pop() if routine.free else Frame(routine)
+                    frame.args[:] = stack[len(stack) - routine.arg_count:]
+                    frames[-1] = frame
+                    push(ret)
+                    frame.base = len(stack)
+                    push(frame.base)
+                    pc = routine.entry
+                    continue
+            cache = routine.cache
+            if cache is not None:
+                key = tuple(stack[len(stack) - routine.arg_count:])
+                if key in cache.entries:
+                    cache.hits += 1
+                    cache.entries.move_to_end(key)
+                    del stack[len(stack) - routine.arg_count:]
+                    push(cache.entries[key])
+                    continue
+                cache.misses += 1
+            frame = routine.free.pop() if routine.free else Frame(routine)
+            frame.args[:] = stack[len(stack) - routine.arg_count:]
+            frames.append(frame)
+            push(pc)
+            frame.base = len(stack)
+            push(frame.base)
+            pc = routine.entry
+        elif op == RETURN:
+            return_value = pop()
+            frame = frames.pop()
+            routine = frame.routine
+            if frame.saved is not None:
+                del stack[-len(frame.saved):]
+                for child, link in zip(routine.children, frame.saved):
+                    child.link = link
+                frame.saved = None
+            pop() # Pop the base pointer for parity
+            pc = pop()
+            if arg > 0:
+                del stack[-arg:]
+            push(return_value)
+            if routine.cache is not None:
+                routine.cache.store(tuple(frame.args), return_value)
+            routine.free.append(frame)
+        elif op == JUMP_IF_ZERO:
+            if not pop():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == ADD:
+            a = pop()
+            b = pop()
+            push(a + b)
+        elif op == SUB:
+            b = pop()
+            a = pop()
+            push(a - b)
+        elif op == EQ:
+            a = pop()
+            b = pop()
+            push(1 if a == b else 0)
+        elif op == NOT:
+            push(1 if pop() == 0 else 0)
+        elif op == VOID:
+            pop()
+        elif op == PEEK:
+            a = pop()
+            push(stack[-(a+1)])
+        elif op == STORE_GLOBAL:
+            values[arg] = pop()
+        elif op == LOAD_OUTER:
+            routine, slot, name = arg
+            # The link is gone once the call the function was defined in
+            # has returned, e.g. when the function is called through a name
+            # bound to it after that.
+            if routine.link is None:
+                raise Exception(f"Label '{name}' is undefined outside its enclosing call.")
+            push(routine.link.args[slot])
+        elif op == FUNC:
+            arg.link = frames[-1] if frames else None
+            push(arg.index)
+            pc = arg.end
+        elif op == ENTER:
+            frame = frames[-1]
+            frame.saved = [child.link for child in arg.children]
+            for link in frame.saved:
+                push(0 if link is None else link.base)
+        elif op == MUL:
+            a = pop()
+            b = pop()
+            push(a * b)
+        elif op == DIV:
+            b = pop()
+            a = pop()
+            push(a // b)
+        elif op == MOD:
+            b = pop()
+            a = pop()
+            push(a % b)
+        elif op == PRINT:
+            stdout.write_int(pop())
         else:
-            raise Exception(f"Unrecognised operator '{op}'.")
-    else:
-        type = token["type"]
-        raise Exception(f"Unknown token type '{type}'.")
-    # print(stack)
-    return ip
+            raise Exception(f"Unknown opcode {op}.")
+    return pc
 
 
-def interpret(tokens):
-    stack = []
-    ip = 0
-    queue = deque()
+def interpret(tokens, stdout=None, memo=None):
+    # tokens can be any iterable of top-level tokens, including the generator
+    # returned by tokenize_stream, in which case execution starts before the
+    # rest of the program has been parsed. Memoization needs the whole
+    # program up front to tell which functions are pure.
+    if stdout is None:
+        stdout = console_output()
 
-    symbols = SymbolTable()
+    stack = []
+    code = []
+    frames = []
+    globals = Globals()
     funcs = []
 
-    while ip < len(tokens) or len(queue) > 0:
-        if len(queue) > 0:
-            token = queue.popleft()
-        else:
-            token = tokens[ip]
-            ip += 1
-        ip = execute(ip, token, stack, queue, symbols, funcs)
+    if memo is not None:
+        tokens = list(tokens)
+
+    if isinstance(tokens, list):
+        # The whole program is known, so names that are never bound can be
+        # reported before anything runs.
+        resolve(tokens, globals)
+        globals.check()
+        if memo is not None:
+            mark_pure(tokens)
+        segments = [mark_tail_calls(tokens)]
+    else:
+        segments = (mark_tail_calls(resolve([token], globals)) for token in tokens)
+
+    try:
+        for segment in segments:
+            pc = len(code)
+            lower(segment, code, funcs, memo)
+            run(code, pc, stack, frames, globals, funcs, stdout)
+    finally:
+        stdout.flush()
 
     return stack
\ No newline at end of file
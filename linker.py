@@ -0,0 +1,171 @@
+from functools import lru_cache
+
+from emulator import MacroTable, expand_line, explode_line, render_instruction, split_source
+from nodes import REFERENCE, CONSTANT, IF, IF_ELSE, FUNCTION, If, IfElse
+from purity import find_bindings
+
+# The linker puts a compiled program together with only the parts of the
+# standard library it uses. Routines in stdlib/functions.lmc are the groups
+# of lines between blank lines, and cells in stdlib/data.lmc are single
+# lines. A routine or cell is kept when a label it defines is named by the
+# program or, in turn, by something else that is kept, following macros to
+# the labels they expand to. The last cell is the base of the stack, so it
+# is always kept, and stays last.
+#
+# Before code generation, functions bound once at the top level
+# ("fn ... is name") whose name is never read by code that can run are
+# dropped along with their binding.
+
+
+def global_reads(tokens, skip):
+    # Names of globals read by tokens, leaving out the bodies of the
+    # functions in skip.
+    names = set()
+    for token in tokens:
+        kind = token.kind
+        if kind == REFERENCE and token.depth is None:
+            names.add(token.name)
+        elif kind == IF:
+            names |= global_reads(token.block, skip)
+        elif kind == IF_ELSE:
+            names |= global_reads(token.block, skip) | global_reads(token.else_block, skip)
+        elif kind == FUNCTION and id(token) not in skip:
+            names |= global_reads(token.block, skip)
+    return names
+
+
+def drop_bindings(tokens, dead):
+    out = []
+    for token in tokens:
+        kind = token.kind
+        if kind == CONSTANT and token.name in dead and len(out) > 0 and out[-1] is dead[token.name]:
+            out.pop()
+            continue
+        if kind == IF:
+            token = If(drop_bindings(token.block, dead))
+        elif kind == IF_ELSE:
+            token = IfElse(drop_bindings(token.block, dead), drop_bindings(token.else_block, dead))
+        out.append(token)
+    return out
+
+
+def prune_functions(tokens):
+    # Runs after resolver.resolve, and after fold.fold_constants so that
+    # reads it folds away don't keep a function alive.
+    _, functions = find_bindings(tokens)
+    skip = {id(func) for func in functions.values()}
+    live = global_reads(tokens, skip)
+    pending = [name for name in live if name in functions]
+    while len(pending) > 0:
+        for name in global_reads(functions.pop(pending.pop()).block, skip):
+            if name in functions and name not in live:
+                pending.append(name)
+            live.add(name)
+    if len(functions) == 0:
+        return tokens
+    return drop_bindings(tokens, functions)
+
+
+class Program():
+    # A linked program: the instructions it assembles to, which the assembler
+    # takes directly, and the parts it is written as in LMC source. The
+    # source is only rendered when the program is printed or written out.
+    __slots__ = ("parts", "instructions")
+
+    def __init__(self, parts, instructions):
+        self.parts = parts
+        self.instructions = instructions
+
+    def __str__(self):
+        macros, asm, routines, data, cells = self.parts
+        return "\n".join([
+            macros,
+            *map(render_instruction, asm),
+            routines,
+            *map(render_instruction, data),
+            *cells,
+        ])
+
+
+def parse_unit(lines, macros):
+    # Returns the instructions lines of source assemble to, the labels they
+    # define and the labels they name.
+    instructions = []
+    for line in lines:
+        parts = explode_line(line)
+        if len(parts) == 0:
+            continue
+        expanded = expand_line(parts, macros)
+        if expanded is None:
+            raise Exception(f"Malformed instruction:\n  {line}")
+        instructions += expanded
+    return instructions, *unit_labels(instructions)
+
+
+def unit_labels(instructions):
+    defined = {label for label, _, _, _ in instructions if label is not None}
+    named = {operand for _, _, _, operand in instructions if isinstance(operand, str)}
+    return defined, named
+
+
+def expand_unit(instructions, macros):
+    # Expands the macros in a list of instructions the compiler generated.
+    expanded = []
+    for instruction in instructions:
+        if instruction[1] in macros:
+            expanded += macros.expand_instruction(instruction)
+        else:
+            expanded.append(instruction)
+    return expanded
+
+
+@lru_cache(maxsize=8)
+def parse_stdlib(macros, functions, data):
+    # Routines are the groups of lines between blank lines, cells are lines.
+    macros = MacroTable(split_source(macros)[0])
+    routines = [text.split("\n") for text in functions.split("\n\n")]
+    cells = [[line] for line in data.split("\n")]
+    return macros, len(routines), [(lines, *parse_unit(lines, macros)) for lines in routines + cells]
+
+
+def link(asm, stdlib, data=()):
+    # asm is the program as a list of instructions, which may use the
+    # standard library's macros, and data any cells of its own to go before
+    # the standard library's. Returns the linked Program.
+    macros, count, units = parse_stdlib(stdlib["macros"], stdlib["functions"], stdlib["data"])
+
+    code = expand_unit(asm, macros)
+    cells = expand_unit(data, macros)
+    needed = unit_labels(code)[1] | unit_labels(cells)[1] | [defined for _, _, defined, _ in units if len(defined) > 0][-1]
+    kept = set()
+    changed = True
+    while changed:
+        changed = False
+        for i, (_, _, defined, named) in enumerate(units):
+            if i not in kept and not defined.isdisjoint(needed):
+                kept.add(i)
+                needed |= named
+                changed = True
+
+    # Lines that define nothing, such as comments, are kept with the
+    # functions only if some routine is.
+    keep = [i in kept or len(defined) == 0 for i, (_, _, defined, _) in enumerate(units)]
+    if not any(i in kept for i in range(count)):
+        keep[:count] = [False] * count
+    routines = [unit for unit, k in zip(units[:count], keep) if k]
+    stdlib_cells = [unit for unit, k in zip(units[count:], keep[count:]) if k]
+
+    parts = (
+        stdlib["macros"],
+        asm,
+        "\n\n".join("\n".join(text) for text, _, _, _ in routines),
+        data,
+        [text[0] for text, _, _, _ in stdlib_cells],
+    )
+    instructions = code
+    for _, unit, _, _ in routines:
+        instructions += unit
+    instructions += cells
+    for _, unit, _, _ in stdlib_cells:
+        instructions += unit
+    return Program(parts, instructions)
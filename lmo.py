@@ -0,0 +1,71 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# LMC object (.lmo) layout, all little-endian:
+#
+#   header   magic "LMO\0", u16 version, u16 reserved, u32 word count,
+#            u32 symbol count
+#   words    one 32-bit instruction word per memory cell, in the
+#            OOOOPPMM AAAAAAAA AAAAAAAA AAAAAAAA layout produced by flatten()
+#   symbols  per label: u32 address, u16 name length, UTF-8 name
+#
+# The header is 16 bytes long so the words start 4-byte aligned and can be
+# read straight out of a memory mapping. A file that isn't a well-formed
+# object raises ValueError, which the cache treats as a miss.
+
+MAGIC = b"LMO\0"
+VERSION = 1
+header = struct.Struct("<4sHHII")
+symbol = struct.Struct("<IH")
+
+
+def write_object(file_name, instructions, labels):
+    words = array("i", instructions)
+    if sys.byteorder != "little":
+        words.byteswap()
+    with open(file_name, "wb") as file:
+        file.write(header.pack(MAGIC, VERSION, 0, len(words), len(labels)))
+        file.write(words.tobytes())
+        for name, address in labels.items():
+            encoded = name.encode("utf-8")
+            file.write(symbol.pack(address, len(encoded)))
+            file.write(encoded)
+
+
+def read_object(file_name):
+    with open(file_name, "rb") as file:
+        if os.fstat(file.fileno()).st_size < header.size:
+            raise ValueError(f"'{file_name}' is too short to be an LMC object.")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with data:
+        magic, version, _, count, symbol_count = header.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"'{file_name}' is not an LMC object.")
+        if version != VERSION:
+            raise ValueError(f"Unsupported LMC object version {version}.")
+
+        end = header.size + count * 4
+        if end > len(data):
+            raise ValueError(f"'{file_name}' is truncated.")
+        instructions = array("i")
+        instructions.frombytes(data[header.size:end])
+        if sys.byteorder != "little":
+            instructions.byteswap()
+
+        labels = {}
+        offset = end
+        for _ in range(symbol_count):
+            if offset + symbol.size > len(data):
+                raise ValueError(f"'{file_name}' is truncated.")
+            address, length = symbol.unpack_from(data, offset)
+            offset += symbol.size
+            if offset + length > len(data):
+                raise ValueError(f"'{file_name}' is truncated.")
+            labels[bytes(data[offset:offset + length]).decode("utf-8")] = address
+            offset += length
+
+    return instructions, labels
@@ -0,0 +1,103 @@
+# Token tree nodes shared by the parser, the interpreter and the compiler.
+# Every node class has a small integer kind so that the engines can dispatch
+# on it without comparing strings.
+
+NUM = 0
+OP = 1
+REFERENCE = 2
+CONSTANT = 3
+IF = 4
+IF_ELSE = 5
+FUNCTION = 6
+
+
+class Node():
+    __slots__ = ()
+    kind = None
+    fields = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self.fields)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(repr(getattr(self, f)) for f in self.fields))
+
+
+class Num(Node):
+    # The compiler pushes literals modulo 255, except exact values, which
+    # come from constant folding.
+    __slots__ = ("value", "exact")
+    kind = NUM
+    fields = __slots__
+
+    def __init__(self, value):
+        self.value = value
+        self.exact = False
+
+
+class Op(Node):
+    # tail and callee are filled in by tailcall.mark_tail_calls.
+    __slots__ = ("op", "tail", "callee")
+    kind = OP
+    fields = ("op",)
+
+    def __init__(self, op):
+        self.op = op
+        self.tail = False
+        self.callee = None
+
+
+class Reference(Node):
+    # depth and slot are filled in by resolver.resolve.
+    __slots__ = ("name", "depth", "slot")
+    kind = REFERENCE
+    fields = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+        self.depth = None
+        self.slot = None
+
+
+class Constant(Node):
+    # depth and slot are filled in by resolver.resolve.
+    __slots__ = ("name", "depth", "slot")
+    kind = CONSTANT
+    fields = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+        self.depth = None
+        self.slot = None
+
+
+class If(Node):
+    __slots__ = ("block",)
+    kind = IF
+    fields = __slots__
+
+    def __init__(self, block):
+        self.block = block
+
+
+class IfElse(Node):
+    __slots__ = ("block", "else_block")
+    kind = IF_ELSE
+    fields = __slots__
+
+    def __init__(self, block, else_block):
+        self.block = block
+        self.else_block = else_block
+
+
+class Function(Node):
+    # pure is filled in by purity.mark_pure.
+    __slots__ = ("args", "block", "pure")
+    kind = FUNCTION
+    fields = ("args", "block")
+
+    def __init__(self, args, block):
+        self.args = args
+        self.block = block
+        self.pure = False
+
@@ -1,252 +1,247 @@
+import gc
 import re
-
-class Result():
-    def __init__(self, value):
-        self.value = value
-
-Empty = Result(None)
-Fail = Result(None)
-
-class Matcher():
-    def __call__(self, source):
+from collections import namedtuple
+from itertools import chain, islice
+
+import nodes
+
+# The lexer turns source text into a stream of lexemes with one compiled
+# pattern. Whitespace is dropped, names that are keywords or the 'void'
+# operator are given their own kinds, and each lexeme keeps its line and
+# column for error messages. The stream always ends with an "eof" lexeme.
+Lexeme = namedtuple("Lexeme", ["kind", "text", "line", "col"])
+
+lexeme_expr = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<num>0|[1-9][0-9]{,2})
+  | (?P<name>[_a-zA-Z][_a-zA-Z0-9]*)
+  | (?P<op>[-+*/%=.@!~])
+  | (?P<punct>[?:{}()])
+  | (?P<error>.)
+""", re.VERBOSE | re.DOTALL)
+
+keywords = {
+    "fn": "keyword",
+    "is": "keyword",
+    "void": "op",
+}
+
+
+def lex_chunks(chunks):
+    # Lexes text that arrives in chunks. Each chunk is only lexed up to its
+    # last whitespace character, so that a lexeme is never split between two
+    # chunks; the remainder is carried over to the next one.
+    line, line_start = 1, 0
+    rest = ""
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            window, rest = rest, ""
+        else:
+            buffer = rest + chunk
+            cut = max(buffer.rfind(c) for c in " \t\r\n") + 1
+            window, rest = buffer[:cut], buffer[cut:]
+
+        for match in lexeme_expr.finditer(window):
+            kind = match.lastgroup
+            text = match.group()
+            if kind == "ws":
+                if "\n" in text:
+                    line += text.count("\n")
+                    line_start = match.start() + text.rfind("\n") + 1
+                continue
+            col = match.start() - line_start + 1
+            if kind == "error":
+                raise Exception(f"Unexpected character '{text}' at line {line}, col {col}.")
+            if kind == "name":
+                kind = keywords.get(text, kind)
+            yield Lexeme(kind, text, line, col)
+        line_start -= len(window)
+
+    yield Lexeme("eof", "", line, -line_start + 1)
+
+
+def lex(source):
+    return lex_chunks([source])
+
+
+class LexemeStream():
+    # A window onto a lexeme generator that can stand in for a list of
+    # lexemes. Lexemes are pulled from the generator as the parser reaches
+    # them, and release() drops those the parser no longer needs.
+    def __init__(self, lexemes):
+        self.lexemes = lexemes
+        self.buffer = []
+        self.offset = 0
+
+    def __getitem__(self, pos):
+        index = pos - self.offset
+        while index >= len(self.buffer):
+            self.buffer.append(next(self.lexemes))
+        return self.buffer[index]
+
+    def release(self, pos):
+        del self.buffer[:pos - self.offset]
+        self.offset = pos
+
+
+class LexemeTexts():
+    # The texts of the lexemes in a LexemeStream, which is all the parser
+    # looks at.
+    def __init__(self, lexemes):
+        self.lexemes = lexemes
+
+    def __getitem__(self, pos):
+        return self.lexemes[pos].text
+
+
+# The grammar is parsed by hand, by recursive descent over the texts of the
+# lexemes, with "" standing for the end of the input:
+#
+#   segment   = item {item}
+#   item      = statement | operator | number | name
+#   statement = "?" block [":" block] | "fn" "(" name {name} ")" block
+#             | "is" name
+#   block     = "{" segment "}"
+#
+# A program is a segment, or nothing at all.
+# A lexeme's kind can be told from its first character, so the parser only
+# needs the texts. Each parse function returns (token, position after it),
+# or None if there is no match at pos. A malformed statement is not an item,
+# so like anything else that isn't one it ends the segment it is in.
+
+digits = set("0123456789")
+name_starts = set("_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+operators = set("-+*/%=.@!~")
+
+
+def is_name(text):
+    return text[:1] in name_starts and text not in keywords
+
+
+def parse_item(texts, pos):
+    text = texts[pos]
+    first = text[:1]
+    if first in operators:
+        return nodes.Op(text), pos + 1
+    if first in digits:
+        return nodes.Num(int(text)), pos + 1
+    if first in name_starts:
+        if text not in keywords:
+            return nodes.Reference(text), pos + 1
+        if text == "void":
+            return nodes.Op(text), pos + 1
+        if text == "is":
+            if is_name(texts[pos + 1]):
+                return nodes.Constant(texts[pos + 1]), pos + 2
+            return None
+        return parse_function(texts, pos)
+    if text == "?":
+        return parse_if(texts, pos)
+    return None
+
+
+def parse_segment(texts, pos):
+    # Returns the items from pos up to the first lexeme that doesn't start
+    # one, and the position of that lexeme.
+    items = []
+    while True:
+        match = parse_item(texts, pos)
+        if match is None:
+            return items, pos
+        items.append(match[0])
+        pos = match[1]
+
+
+def parse_block(texts, pos):
+    if texts[pos] != "{":
         return None
-    
-    def __rshift__(self, action):
-        return Process(self, action)
-    
-    def __add__(self, other):
-        return Sequence(self, other)
-    
-    def __or__(self, other):
-        return Alternate(self, other)
-
-
-class Optional(Matcher):
-    def __init__(self, matcher):
-        self.matcher = matcher
-    
-    def __call__(self, source):
-        match, rest = self.matcher(source)
-        if match is not Fail:
-            return (Result(match.value), rest)
-        return (Empty, source)
-
-
-class Sequence(Matcher):
-    def __init__(self, *matchers, ignore_whitespace=True):
-        self.matchers = matchers
-        self.ignore_whitepace = ignore_whitespace
-
-    def __add__(self, matcher):
-        return Sequence(*self.matchers, matcher)
-
-    def __call__(self, source):
-        matches = []
-        rest = source
-        for matcher in self.matchers:
-            if self.ignore_whitepace:
-                rest = rest.lstrip()
-            match, rest = matcher(rest)
-            if match is Fail:
-                return (Fail, source)
-            matches.append(match.value)
-        if self.ignore_whitepace:
-            rest = rest.lstrip()
-        return (Result(matches), rest)
-
-
-class Alternate(Matcher):
-    def __init__(self, *matchers):
-        self.matchers = matchers
-    
-    def __or__(self, matcher):
-        return Alternate(*self.matchers, matcher)
-
-    def __call__(self, source):
-        for matcher in self.matchers:
-            match, rest = matcher(source)
-            if match is not Fail:
-                return (Result(match.value), rest)
-        return (Fail, source)
-
-
-class Repeat(Matcher):
-    def __init__(self, matcher, ignore_whitespace=True):
-        self.matcher = matcher
-        self.ignore_whitespace = ignore_whitespace
-    
-    def __call__(self, source):
-        matches = []
-        rest = source
-        while len(rest) > 0:
-            if self.ignore_whitespace:
-                rest = rest.lstrip()
-            match, rest = self.matcher(rest)
-            if match is Fail:
-                break
-            matches.append(match.value)
-        if self.ignore_whitespace:
-            rest = rest.lstrip()
-        if len(matches) > 0:
-            return (Result(matches), rest)
-        return (Fail, source)
-
-
-class Symbol(Matcher):
-    def __init__(self, value):
-        self.value = value
-
-    def __call__(self, source):
-        if source.startswith(self.value):
-            match = self.value
-            rest = source[len(match):]
-            return (Result(match), rest)
-        return (Fail, source)
-
-
-class RegExp(Matcher):
-    def __init__(self, expr):
-        self.expr = expr
-    
-    def __call__(self, source):
-        re_match = re.match(self.expr, source)
-        if re_match is not None:
-            match = re_match.group(0)
-            rest = source[len(match):]
-            return (Result(match), rest)
-        return (Fail, source)
-
-
-class Lazy(Matcher):
-    def __init__(self, matcher_func):
-        self.matcher_func = matcher_func
-        self.matcher = None
-    
-    def __call__(self, source):
-        if self.matcher is None:
-            self.matcher = self.matcher_func()
-        return self.matcher(source)
-
-
-class Process(Matcher):
-    def __init__(self, matcher, action):
-        self.matcher = matcher
-        self.action = action
-    
-    def __call__(self, source):
-        match, rest = self.matcher(source)
-        if match is Fail:
-            return (Fail, source)
-        processed = self.action(match.value)
-        
-        return (Result(processed), rest)
-
-
-class Action():
-    def __call__(self, match):
+    items, end = parse_segment(texts, pos + 1)
+    if len(items) == 0 or texts[end] != "}":
         return None
+    return items, end + 1
 
 
-class SimpleAction(Action):
-    def __init__(self, transformer):
-        self.transformer = transformer
-    
-    def __call__(self, match):
-        return self.transformer(match)
-
-
-class Entoken(Action):
-    def __init__(self, type):
-        self.type = type
-    
-    def __call__(self, value):
-        return {
-            "type": self.type,
-            "value": value
-        }
-
-class Select(Action):
-    def __init__(self, *indices):
-        self.indices = indices
-    
-    def __call__(self, values):
-        if len(self.indices) == 1:
-            return values[self.indices[0]]
-        return [v for i, v in enumerate(values) if i in self.indices]
-
-class Map(Action):
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, values):
-        return { key: values[index] for key, index in self.kwargs.items() }
-
-def WS():
-    return RegExp("^[ \t\r\n]+")
-
-def Num():
-    return RegExp(r"^(0|([1-9][0-9]{,2}))") >> SimpleAction(int)
-
-def NumberLiteral():
-    return Num() >> Entoken("num")
-
-def Literal():
-    return NumberLiteral()
-
-Op =  lambda op: Symbol(op) >> Entoken("op")
-def Operator():
-    return Op("+") | Op("-") | Op("*") | Op("/") | Op("%") | Op("=") | Op(".") | Op("@") | Op("!") | Op("~") | Op("void")
-
-def Name():
-    return RegExp(r"[_a-zA-Z][_a-zA-Z0-9]*")
-
-def Reference():
-    return Name() >> Entoken("reference")
-
-def ArgumentList():
-    return Symbol("(") + Repeat(Name()) + Symbol(")") \
-        >> Select(1)
-
-def FuncStmt():
-    return (Symbol("fn") + ArgumentList() + Block()) \
-        >> Map(args=1, block=2) >> Entoken("function")
-
-def ConstStmt():
-    return Sequence(Symbol("is"), WS(), Name(), ignore_whitespace=False) \
-        >> Select(2) >> Entoken("constant")
+def parse_if(texts, pos):
+    match = parse_block(texts, pos + 1)
+    if match is None:
+        return None
+    block, end = match
+    if texts[end] == ":":
+        match = parse_block(texts, end + 1)
+        if match is not None:
+            return nodes.IfElse(block, match[0]), match[1]
+    return nodes.If(block), end
 
-def IfStmt():
-    return (Symbol("?") + Block()) \
-        >> Select(1) >> Entoken("if")
 
-def IfElseStmt():
-    return (Symbol("?") + Block() + Symbol(":") + Block()) \
-        >> Select(1, 3) >> Entoken("if-else")
+def parse_function(texts, pos):
+    if texts[pos + 1] != "(":
+        return None
+    args = []
+    end = pos + 2
+    while is_name(texts[end]):
+        args.append(texts[end])
+        end += 1
+    if len(args) == 0 or texts[end] != ")":
+        return None
+    match = parse_block(texts, end + 1)
+    if match is None:
+        return None
+    return nodes.Function(args, match[0]), match[1]
 
-def Statement():
-    return Lazy(IfElseStmt) | Lazy(IfStmt) | Lazy(FuncStmt) | Lazy(ConstStmt)
 
-def Segment():
-    return Repeat(Statement() | Operator() | Literal() | Reference())
+# The texts of the lexemes lexeme_expr matches, in the same order, leaving
+# out whitespace. Without groups, findall returns them as a list of strings,
+# which is much faster to build than Lexemes. Characters that can't start a
+# lexeme are looked for separately.
+text_expr = re.compile(r"0|[1-9][0-9]{,2}|[_a-zA-Z][_a-zA-Z0-9]*|[-+*/%=.@!~?:{}()]")
+unexpected_expr = re.compile(r"[^\s_a-zA-Z0-9\-+*/%=.@!~?:{}()]")
 
-def Block():
-    return (Symbol("{") + Segment() + Symbol("}")) \
-        >> Select(1)
 
-parser = Segment()
+def lexeme_at(source, pos):
+    # Only used for error messages, so the source is lexed again in full.
+    return next(islice(lex(source), pos, None))
 
 
 def tokenize(source):
-    match, rest = parser(source)
-
-    if match is Fail:
-        col = len(source) - len(rest)
-        raise Exception(f"No match found at col {col}.")
-
-    if rest != "":
-        col = len(source) - len(rest)
-        raise Exception(f"Expected end of string, found '{rest[:1]}' at col {col}.")
-
-    tokens = match.value
-
-    return tokens
\ No newline at end of file
+    if unexpected_expr.search(source) is not None:
+        # Raises the lexer's error for the first such character.
+        for _ in lex(source):
+            pass
+    texts = text_expr.findall(source)
+    texts.append("")
+
+    # None of the hundreds of thousands of nodes a large file parses to can
+    # be garbage until the parse is over, so the collector is paused rather
+    # than left to scan the growing tree over and over.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        tokens, pos = parse_segment(texts, 0)
+    finally:
+        if enabled:
+            gc.enable()
+
+    if texts[pos] != "":
+        lexeme = lexeme_at(source, pos)
+        if len(tokens) == 0:
+            raise Exception(f"No match found at line {lexeme.line}, col {lexeme.col}.")
+        raise Exception(f"Expected end of string, found '{lexeme.text}' at line {lexeme.line}, col {lexeme.col}.")
+
+    return tokens
+
+
+def tokenize_stream(file, chunk_size=1 << 16):
+    # Yields the top-level tokens of a file one at a time, as soon as each has
+    # been parsed. Only the text and lexemes of the statement being parsed are
+    # held in memory.
+    lexemes = LexemeStream(lex_chunks(iter(lambda: file.read(chunk_size), "")))
+    texts = LexemeTexts(lexemes)
+    pos = 0
+    while lexemes[pos].kind != "eof":
+        match = parse_item(texts, pos)
+        if match is None:
+            lexeme = lexemes[pos]
+            raise Exception(f"No match found at line {lexeme.line}, col {lexeme.col}.")
+        token, pos = match
+        lexemes.release(pos)
+        yield token
@@ -0,0 +1,159 @@
+from emulator import DIRECT, IMMEDIATE, INDIRECT
+
+# The peephole optimizer rewrites the compiler's output before it is linked.
+# It works on the compiler's (label, mnemonic, mode, operand) instructions,
+# where the mnemonic may be one of the standard library's stack macros, so
+# rules can match a whole PUSHACC or POP rather than the four instructions
+# it expands to. The rules in the table run over every
+# adjacent pair of instructions, the passes over the whole list, and both
+# repeat until nothing changes.
+#
+#   -O1  pairs of stack macros and loads/stores that cancel out, and NOP
+#        lines that only carry a label
+#   -O2  also branches to the next line, branches to branches, code that
+#        can't be reached and labels that are never used
+
+# Macros that overwrite the accumulator before reading it.
+loads_first = {"LDA", "PUSH", "POP", "PEEK"}
+branches = {"BRA", "BRZ", "BRP"}
+
+
+def target(instruction):
+    # The label a branch goes to, when it is known before the program runs.
+    _, _, mode, operand = instruction
+    if mode != IMMEDIATE or not isinstance(operand, str):
+        return None
+    return operand
+
+
+def rename(instruction, aliases):
+    label, mnemonic, mode, operand = instruction
+    if isinstance(operand, str) and operand in aliases:
+        return (label, mnemonic, mode, aliases[operand])
+    return instruction
+
+
+# Rules: each takes two adjacent instructions and returns what replaces them,
+# or None to leave them alone.
+
+def push_pop(a, b):
+    # PUSHACC then POP leaves the accumulator as it was.
+    if a[1] == "PUSHACC" and b[0] is None and b[1] == "POP":
+        return [(a[0], "NOP", IMMEDIATE, None)]
+    if a[1] == "PUSH" and b[0] is None and b[1] == "POP":
+        return [(a[0], "LDA", *a[2:])]
+
+
+def store_load(a, b):
+    if a[1] == "STA" and b[0] is None and b[1] == "LDA" and a[2:] == b[2:] and a[2] in [DIRECT, INDIRECT]:
+        return [a]
+
+
+def dead_load(a, b):
+    if a[1] == "LDA" and b[0] is None and b[1] in loads_first:
+        return [(a[0], *b[1:])]
+
+
+def nop_label(a, b):
+    if a[1] == "NOP" and b[0] is None:
+        return [(a[0], *b[1:])]
+
+
+def branch_to_next(a, b):
+    if a[1] in branches and b[0] is not None and target(a) == b[0]:
+        return [(a[0], "NOP", IMMEDIATE, None), b]
+
+
+def unreachable(a, b):
+    if a[1] in ["BRA", "HLT"] and b[0] is None and b[1] != "DAT":
+        return [a]
+
+
+rules = [
+    (1, push_pop),
+    (1, store_load),
+    (1, dead_load),
+    (1, nop_label),
+    (2, branch_to_next),
+    (2, unreachable),
+]
+
+
+# Passes: each takes the whole list of instructions and returns a new one.
+
+def merge_labels(instructions):
+    # A labelled NOP followed by another label is dropped, and branches to
+    # its label go to the next one instead. Unlabelled NOPs are dropped.
+    aliases = {}
+    kept = []
+    for i, instruction in enumerate(instructions):
+        label, mnemonic, _, _ = instruction
+        if mnemonic == "NOP" and i + 1 < len(instructions):
+            following = instructions[i + 1][0]
+            if label is None:
+                continue
+            if following is not None:
+                aliases[label] = following
+                continue
+        kept.append(instruction)
+    for label in aliases:
+        seen = {label}
+        while aliases[label] in aliases and aliases[label] not in seen:
+            seen.add(aliases[label])
+            aliases[label] = aliases[aliases[label]]
+    return [rename(instruction, aliases) for instruction in kept]
+
+
+def thread_jumps(instructions):
+    jumps = {instruction[0]: instruction for instruction in instructions if instruction[0] is not None and instruction[1] == "BRA"}
+    threaded = []
+    for instruction in instructions:
+        if instruction[1] in branches:
+            seen = set()
+            while target(instruction) in jumps and target(jumps[target(instruction)]) is not None and target(instruction) not in seen:
+                seen.add(target(instruction))
+                instruction = (*instruction[:2], *jumps[target(instruction)][2:])
+        threaded.append(instruction)
+    return threaded
+
+
+def drop_unused_labels(instructions):
+    used = {operand for _, _, _, operand in instructions if isinstance(operand, str)}
+    return [(label if label in used or mnemonic == "DAT" else None, mnemonic, mode, operand) for label, mnemonic, mode, operand in instructions]
+
+
+passes = [
+    (1, merge_labels),
+    (2, thread_jumps),
+    (2, drop_unused_labels),
+]
+
+
+def apply_rules(instructions, level):
+    active = [rule for rule_level, rule in rules if rule_level <= level]
+    result = []
+    for instruction in instructions:
+        result.append(instruction)
+        while len(result) >= 2:
+            for rule in active:
+                replacement = rule(result[-2], result[-1])
+                if replacement is not None:
+                    result[-2:] = replacement
+                    break
+            else:
+                break
+    return result
+
+
+def optimize(instructions, level=1):
+    # Returns the optimized list of instructions.
+    if level <= 0:
+        return instructions
+    while True:
+        before = instructions
+        instructions = apply_rules(instructions, level)
+        for pass_level, run in passes:
+            if pass_level <= level:
+                instructions = run(instructions)
+        if instructions == before:
+            return instructions
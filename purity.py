@@ -0,0 +1,137 @@
+from nodes import NUM, OP, REFERENCE, CONSTANT, IF, IF_ELSE, FUNCTION
+from resolver import linked_functions
+
+# A function is pure when its result depends only on its arguments, so calls
+# to it can be memoized. The analysis is conservative. A function qualifies
+# only if it prints nothing and binds no constants, reads no names other than
+# its own arguments and globals that are bound once at the top level, only
+# '@' peeks at a literal depth into its own operands or arguments, only '!'
+# calls pure functions by name, and leaves exactly one value on the stack.
+# Functions that save the links of functions defined in them (see resolver)
+# are left out. It runs after resolver.resolve, whose depth it relies on.
+
+binary_ops = {"+", "-", "*", "/", "%", "="}
+
+
+def walk(tokens, in_function=False):
+    # Yields every token in the tree with whether it is inside a function.
+    for token in tokens:
+        yield token, in_function
+        kind = token.kind
+        if kind == IF:
+            yield from walk(token.block, in_function)
+        elif kind == IF_ELSE:
+            yield from walk(token.block, in_function)
+            yield from walk(token.else_block, in_function)
+        elif kind == FUNCTION:
+            yield from walk(token.block, True)
+
+
+def find_bindings(tokens):
+    # Top-level code runs once, so a global with a single binding outside
+    # any function never changes once it has a value. Those bound straight
+    # to a function literal ("fn ... is name") can be called by name.
+    counts = {}
+    in_functions = set()
+    blocks = [tokens]
+    for token, in_function in walk(tokens):
+        if token.kind == CONSTANT:
+            counts[token.name] = counts.get(token.name, 0) + 1
+            if in_function:
+                in_functions.add(token.name)
+        elif token.kind == IF and not in_function:
+            blocks.append(token.block)
+        elif token.kind == IF_ELSE and not in_function:
+            blocks += [token.block, token.else_block]
+    stable = {name for name, count in counts.items() if count == 1 and name not in in_functions}
+
+    functions = {}
+    for block in blocks:
+        for func, name in zip(block, block[1:]):
+            if func.kind == FUNCTION and name.kind == CONSTANT and name.name in stable:
+                functions[name.name] = func
+    return stable, functions
+
+
+def check_block(tokens, height, arg_count, stable, functions, callees):
+    # Returns the stack height, counted from the start of the function body,
+    # after tokens run, or None if they can't be shown to be pure.
+    prev = None
+    for token in tokens:
+        kind = token.kind
+        if kind == NUM or kind == FUNCTION:
+            height += 1
+        elif kind == REFERENCE:
+            if token.depth is None and token.name not in stable:
+                return None
+            if token.depth not in [None, 0]:
+                return None
+            height += 1
+        elif kind == IF:
+            if height < 1:
+                return None
+            height -= 1
+            if check_block(token.block, height, arg_count, stable, functions, callees) != height:
+                return None
+        elif kind == IF_ELSE:
+            if height < 1:
+                return None
+            height -= 1
+            after = check_block(token.block, height, arg_count, stable, functions, callees)
+            if after is None or after != check_block(token.else_block, height, arg_count, stable, functions, callees):
+                return None
+            height = after
+        elif kind == OP and token.op in binary_ops:
+            if height < 2:
+                return None
+            height -= 1
+        elif kind == OP and token.op in ["~", "void"]:
+            if height < 1:
+                return None
+            if token.op == "void":
+                height -= 1
+        elif kind == OP and token.op == "@":
+            if prev is None or prev.kind != NUM or prev.value >= 255:
+                return None
+            # Below the operands are the base pointer and return address of
+            # the call, then the arguments.
+            depth, below = prev.value, height - 1
+            if not (depth < below or below + 2 <= depth < below + 2 + arg_count):
+                return None
+        elif kind == OP and token.op == "!":
+            if prev is None or prev.kind != REFERENCE or prev.depth is not None or prev.name not in functions:
+                return None
+            callee = functions[prev.name]
+            if height - 1 < len(callee.args):
+                return None
+            height -= len(callee.args)
+            callees.append(callee)
+        else:
+            return None
+        prev = token
+    return height
+
+
+def mark_pure(tokens):
+    stable, functions = find_bindings(tokens)
+
+    candidates = {}
+    for func, _ in walk(tokens):
+        if func.kind != FUNCTION or len(linked_functions(func.block)) > 0:
+            continue
+        callees = []
+        if check_block(func.block, 0, len(func.args), stable, functions, callees) == 1:
+            candidates[id(func)] = (func, callees)
+
+    # A function stays a candidate only while everything it calls does.
+    changed = True
+    while changed:
+        changed = False
+        for key, (func, callees) in list(candidates.items()):
+            if any(id(callee) not in candidates for callee in callees):
+                del candidates[key]
+                changed = True
+
+    for func, _ in candidates.values():
+        func.pure = True
+    return tokens
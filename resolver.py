@@ -0,0 +1,106 @@
+from nodes import REFERENCE, CONSTANT, IF, IF_ELSE, FUNCTION
+
+# Names are resolved before a program runs. A reference to an argument of an
+# enclosing function gets a (depth, slot) address: depth counts enclosing
+# functions outwards from the innermost one, and slot is the argument's
+# position in that function's argument list.
+#
+# At run time, a function that reads such an argument links to the frame of
+# the call that ran its definition, and the argument is found by following
+# those links rather than the call chain. A call saves the links of the
+# functions defined directly in it when it starts, and puts them back when it
+# returns, so a link always points to a call that is still running even when
+# the function it was made in recurses. Once every such call has returned,
+# the link is gone: the interpreter raises an error for a read through it,
+# and compiled code stops. Everything else, including every name bound with
+# 'is', is a global and gets an index in the Globals table instead, with depth
+# None. The interpreter keeps the value of each global alongside its name,
+# None until it is bound.
+
+
+class Globals():
+    def __init__(self):
+        self.names = []
+        self.values = []
+        self.indices = {}
+        self.bound = set()
+        self.used = []
+
+    def index(self, name):
+        if name not in self.indices:
+            self.indices[name] = len(self.names)
+            self.names.append(name)
+            self.values.append(None)
+        return self.indices[name]
+
+    def bind(self, name):
+        self.bound.add(name)
+        return self.index(name)
+
+    def use(self, name):
+        if name not in self.indices:
+            self.used.append(name)
+        return self.index(name)
+
+    def check(self):
+        for name in self.used:
+            if name not in self.bound:
+                raise Exception(f"Label '{name}' is undefined.")
+
+
+def resolve(tokens, globals, scopes=()):
+    # scopes holds the argument lists of the enclosing functions, innermost
+    # last.
+    for token in tokens:
+        kind = token.kind
+        if kind == REFERENCE:
+            token.depth = None
+            for depth, args in enumerate(reversed(scopes)):
+                if token.name in args:
+                    token.depth = depth
+                    token.slot = args.index(token.name)
+                    break
+            else:
+                token.slot = globals.use(token.name)
+        elif kind == CONSTANT:
+            token.depth = None
+            token.slot = globals.bind(token.name)
+        elif kind == IF:
+            resolve(token.block, globals, scopes)
+        elif kind == IF_ELSE:
+            resolve(token.block, globals, scopes)
+            resolve(token.else_block, globals, scopes)
+        elif kind == FUNCTION:
+            resolve(token.block, globals, (*scopes, token.args))
+    return tokens
+
+
+def reads_outer(tokens, nesting):
+    # Whether tokens, nesting functions deep, read an argument of a function
+    # outside the outermost of those.
+    for token in tokens:
+        kind = token.kind
+        if kind == REFERENCE and token.depth is not None and 0 < nesting <= token.depth:
+            return True
+        elif kind == IF and reads_outer(token.block, nesting):
+            return True
+        elif kind == IF_ELSE and (reads_outer(token.block, nesting) or reads_outer(token.else_block, nesting)):
+            return True
+        elif kind == FUNCTION and reads_outer(token.block, nesting + 1):
+            return True
+    return False
+
+
+def linked_functions(tokens):
+    # The functions defined directly in tokens, rather than inside another
+    # function, that read the arguments of the functions enclosing them.
+    found = []
+    for token in tokens:
+        kind = token.kind
+        if kind == IF:
+            found += linked_functions(token.block)
+        elif kind == IF_ELSE:
+            found += linked_functions(token.block) + linked_functions(token.else_block)
+        elif kind == FUNCTION and reads_outer(token.block, 1):
+            found.append(token)
+    return found
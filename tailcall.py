@@ -0,0 +1,41 @@
+from nodes import OP, REFERENCE, IF, IF_ELSE, FUNCTION
+from purity import find_bindings
+from resolver import reads_outer
+
+# A call is in tail position when it is the last thing its function does:
+# the last token of the body, or of a branch that is itself in tail
+# position. Such a call can replace the caller's frame instead of stacking a
+# new one on top of it. Calls by name to a function bound once at the top
+# level also get that function as their callee, for code generators that
+# need to know its argument count.
+#
+# References to the arguments of an enclosing function are read from the
+# frame of the call that defined the nested function, so a function keeps its
+# frame when a function nested inside it makes such a reference.
+
+
+def mark(tokens, tail, functions, keep_frame):
+    for i, token in enumerate(tokens):
+        last = tail and i == len(tokens) - 1
+        kind = token.kind
+        if kind == FUNCTION:
+            keep = reads_outer(token.block, 0) or (keep_frame is not None and keep_frame(token))
+            mark(token.block, not keep, functions, keep_frame)
+        elif kind == IF:
+            mark(token.block, last, functions, keep_frame)
+        elif kind == IF_ELSE:
+            mark(token.block, last, functions, keep_frame)
+            mark(token.else_block, last, functions, keep_frame)
+        elif kind == OP and token.op == "!" and last:
+            token.tail = True
+            prev = tokens[i - 1] if i > 0 else None
+            if prev is not None and prev.kind == REFERENCE and prev.depth is None and prev.name in functions:
+                token.callee = functions[prev.name]
+
+
+def mark_tail_calls(tokens, keep_frame=None):
+    # keep_frame(func) can rule out tail calls from a function whose frame
+    # is still needed when it returns. Runs after resolver.resolve.
+    _, functions = find_bindings(tokens)
+    mark(tokens, False, functions, keep_frame)
+    return tokens
@@ -0,0 +1,50 @@
+import pytest
+
+from channels import OutputChannel
+from compiler import compile
+from emulator import emulate
+from interpreter import interpret
+from parser import tokenize
+
+# The operators are called through functions so that constant folding
+# leaves them to std_mul and std_div. Operands are built from small literals,
+# which the compiler pushes modulo 255, and folded to their exact values.
+functions = """
+fn (a b) { a b * } is mul
+fn (a b) { a b / } is div
+fn (a b) { a b % } is mod
+"""
+
+
+def number(value):
+    if value < 0:
+        return f"0 {number(-value)} -"
+    if value < 255:
+        return str(value)
+    return f"{number(value // 200)} 200 * {value % 200} +"
+
+
+def run(source, level):
+    interpreted = OutputChannel()
+    interpret(tokenize(source), interpreted)
+    compiled = OutputChannel()
+    emulate(compile(tokenize(source), level=level).instructions, stdout=compiled)
+    assert compiled.getvalue() == interpreted.getvalue()
+    return [int(line) for line in compiled.getvalue().split()]
+
+
+products = [(0, 7), (7, 0), (1, 1), (12, 34), (-5, 9), (9, -5), (-6, -7), (40000, 123), (123, 40000), (46340, 46340), (1, -2147483647)]
+# std_div, like the routine it replaced, only divides non-negative numbers.
+quotients = [(0, 3), (7, 1), (7, 7), (6, 7), (40000, 7), (7, 40000), (255, 255), (2147483647, 2), (2147483647, 65536), (99999, 1000)]
+
+
+@pytest.mark.parametrize("level", [0, 2])
+def test_multiply(level):
+    source = functions + "".join(f"{number(a)} {number(b)} mul! .\n" for a, b in products)
+    assert run(source, level) == [a * b for a, b in products]
+
+
+@pytest.mark.parametrize("level", [0, 2])
+def test_divide(level):
+    source = functions + "".join(f"{number(a)} {number(b)} div! . {number(a)} {number(b)} mod! .\n" for a, b in quotients)
+    assert run(source, level) == [n for a, b in quotients for n in (a // b, a % b)]
@@ -0,0 +1,56 @@
+import pytest
+
+from channels import InputChannel, OutputChannel
+from compiler import compile
+from emulator import assemble, emulate, emulate_batch
+from parser import tokenize
+from test_emulator import self_modifying
+
+np = pytest.importorskip("numpy")
+
+# Stores each lane's input into the operand of an instruction, so the lanes
+# run different code from there on.
+patched_operand = """
+      INP
+      STA &slot
+      LDA #9
+slot  DAT
+      OUT
+      HLT
+"""
+
+echo = """
+loop  ITC
+      BRZ stop
+      OTC
+      BRA loop
+stop  HLT
+"""
+
+
+def check(source, inputs):
+    outputs, memory = emulate_batch(source, inputs)
+    for values, output, lane in zip(inputs, outputs, memory):
+        stdout = OutputChannel()
+        stdin = InputChannel.from_text(values) if isinstance(values, str) else InputChannel.from_values(values)
+        expected = emulate(source, stdin=stdin, stdout=stdout)
+        assert output == stdout.getvalue()
+        assert lane.tolist() == expected.tolist()
+
+
+def test_divergent_lanes():
+    check(self_modifying, [[n] for n in range(0, 40, 3)])
+    check(echo, ["hi", "", "hello\n", "x"])
+
+
+def test_lanes_storing_code():
+    lda = assemble("LDA #5")[0]
+    check(patched_operand, [[0], [lda], [lda + 3], [0]])
+    check(patched_operand, [[lda]] * 3)
+
+
+def test_compiled_program():
+    with open("examples/fib.bmc") as file:
+        program = compile(tokenize(file.read()))
+    check(program.instructions, [[]] * 3)
+    check(assemble(program.instructions), [[]] * 3)
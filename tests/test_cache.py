@@ -0,0 +1,75 @@
+import os
+
+from cache import Cache, cached_assemble, cached_compile, read_pickle, write_pickle
+from compiler import compile
+from emulator import assemble
+from parser import tokenize
+
+
+def entries(cache):
+    return sorted(name for name in os.listdir(cache.directory) if not name.endswith(".tmp"))
+
+
+def test_hit_and_miss(tmp_path):
+    cache = Cache(tmp_path)
+    key = cache.key("test", "a")
+    assert key != cache.key("test", "b")
+    assert key != cache.key("other", "a")
+    assert cache.load(key, ".test", read_pickle) is None
+    cache.store(key, ".test", write_pickle([1, 2, 3]))
+    assert cache.load(key, ".test", read_pickle) == [1, 2, 3]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = Cache(tmp_path)
+    keys = [cache.key("test", str(i)) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, ".test", write_pickle(i))
+        os.utime(cache.path(key, ".test"), (1000 + i, 1000 + i))
+    size = os.path.getsize(cache.path(keys[0], ".test"))
+
+    # Reading the oldest entry makes it the most recently used.
+    assert cache.load(keys[0], ".test", read_pickle) == 0
+    cache.max_size = 2 * size
+    cache.evict()
+    assert cache.load(keys[1], ".test", read_pickle) is None
+    assert cache.load(keys[0], ".test", read_pickle) == 0
+    assert cache.load(keys[2], ".test", read_pickle) == 2
+
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = Cache(tmp_path)
+    key = cache.key("test", "a")
+    cache.store(key, ".test", write_pickle(list(range(100))))
+    path = cache.path(key, ".test")
+    with open(path, "r+b") as file:
+        file.truncate(10)
+    assert cache.load(key, ".test", read_pickle) is None
+    assert not os.path.exists(path)
+
+
+def test_truncated_object_is_a_miss(tmp_path):
+    cache = Cache(tmp_path)
+    code = "LDA #5\nOUT\nHLT\n"
+    expected = assemble(code)
+    assert cached_assemble(code, cache) == expected
+    [name] = entries(cache)
+    with open(os.path.join(tmp_path, name), "r+b") as file:
+        file.truncate(20)
+    assert cached_assemble(code, cache) == expected
+    assert os.path.getsize(os.path.join(tmp_path, name)) > 20
+
+
+def test_cached_compile(tmp_path):
+    cache = Cache(tmp_path)
+    with open("examples/fib.bmc") as file:
+        code = file.read()
+    # Return labels are numbered across compilations, so programs are
+    # compared once assembled.
+    expected = assemble(compile(tokenize(code)).instructions)
+    assert assemble(cached_compile(code, cache).instructions) == expected
+    stored = entries(cache)
+    assert assemble(cached_compile(code, cache).instructions) == expected
+    assert entries(cache) == stored
+    cached_compile(code, cache, level=2)
+    assert len(entries(cache)) == len(stored) + 1
@@ -0,0 +1,67 @@
+from channels import InputChannel, OutputChannel
+from emulator import emulate
+
+# Sums the numbers below its input, then patches the operand of an LDA that
+# has already been decoded and runs it again.
+self_modifying = """
+      INP
+      STA &n
+loop  LDA &n
+      BRZ done
+      SUB #1
+      STA &n
+      LDA &sum
+      ADD &n
+      STA &sum
+      BRA loop
+done  LDA &sum
+      OUT
+      LDA &patch
+      ADD #1
+      STA &patch
+      LDA &count
+      SUB #1
+      STA &count
+      BRZ stop
+patch LDA #65
+      OTC
+      BRA done
+stop  HLT
+n     DAT
+sum   DAT
+count DAT 3
+"""
+
+
+def run(code, values, jit=False):
+    stdout = OutputChannel()
+    emulate(code, jit=jit, stdin=InputChannel.from_values(values), stdout=stdout)
+    return stdout.getvalue()
+
+
+def test_self_modifying_code():
+    assert run(self_modifying, [10]) == "45\nB45\nC45\n"
+
+
+# Prints the alphabet by bumping the operand of an LDA in the same block, so
+# the block has to be dropped and compiled again once it is hot.
+self_patching_loop = """
+loop  LDA &count
+      BRZ stop
+      SUB #1
+      STA &count
+patch LDA #65
+      OTC
+      LDA &patch
+      ADD #1
+      STA &patch
+      BRA loop
+stop  HLT
+count DAT 26
+"""
+
+
+def test_jit_self_modifying_code():
+    assert run(self_modifying, [10], jit=True) == "45\nB45\nC45\n"
+    assert run(self_patching_loop, [], jit=True) == "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    assert run(self_patching_loop, []) == "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
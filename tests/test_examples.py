@@ -0,0 +1,54 @@
+import glob
+import subprocess
+import sys
+
+import pytest
+
+from channels import OutputChannel
+from compiler import MEMO_TABLE_SIZE, compile
+from emulator import emulate
+from parser import tokenize
+
+options = {
+    "O0": ["-O", "0"],
+    "O2": ["-O", "2"],
+    "jit": ["--jit"],
+    "memo": ["--memo"],
+}
+
+# Examples that the interpreter stops with an error. Compiled code halts at
+# the same point instead, after printing the same output.
+errors = {
+    "examples/escaped_closure.bmc": "Label 'n' is undefined outside its enclosing call.",
+}
+
+
+def compare(file_name, flags):
+    return subprocess.run(
+        [sys.executable, "bmc.py", "compare", "-f", file_name, *flags],
+        stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60,
+    )
+
+
+@pytest.mark.parametrize("flags", options.values(), ids=options.keys())
+@pytest.mark.parametrize("file_name", sorted(glob.glob("examples/*.bmc")))
+def test_compare(file_name, flags):
+    result = compare(file_name, flags)
+    if file_name in errors:
+        assert result.returncode != 0
+        assert errors[file_name] in result.stderr
+        interpreted = result.stdout.removeprefix("== INTERPRETED ==\n")
+        memo = MEMO_TABLE_SIZE if "--memo" in flags else 0
+        level = int(flags[flags.index("-O") + 1]) if "-O" in flags else 0
+        with open(file_name) as file:
+            program = compile(tokenize(file.read()), memo=memo, level=level)
+        stdout = OutputChannel()
+        emulate(program.instructions, jit="--jit" in flags, stdout=stdout)
+        assert stdout.getvalue() == interpreted
+        return
+
+    assert result.returncode == 0, result.stderr
+    interpreted, compiled = result.stdout.split("\n== COMPILED ==\n")
+    interpreted = interpreted.removeprefix("== INTERPRETED ==\n")
+    assert compiled == interpreted
+    assert len(compiled) > 0
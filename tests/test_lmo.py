@@ -0,0 +1,53 @@
+import pytest
+
+from emulator import assemble_object
+from lmo import header, read_object, write_object
+
+source = """
+loop  LDA &n
+      BRZ stop
+      SUB #1
+      STA &n
+      BRA loop
+stop  HLT
+n     DAT 3
+"""
+
+
+@pytest.fixture
+def object_file(tmp_path):
+    path = tmp_path / "loop.lmo"
+    write_object(path, *assemble_object(source))
+    return path
+
+
+def test_round_trip(object_file):
+    instructions, labels = read_object(object_file)
+    expected, expected_labels = assemble_object(source)
+    assert instructions.tolist() == list(expected)
+    assert labels == expected_labels
+
+
+@pytest.mark.parametrize("size", [0, header.size - 1, header.size, header.size + 6])
+def test_truncated_words(object_file, size):
+    data = object_file.read_bytes()
+    object_file.write_bytes(data[:size])
+    with pytest.raises(ValueError):
+        read_object(object_file)
+
+
+def test_truncated_symbols(object_file):
+    instructions, labels = read_object(object_file)
+    data = object_file.read_bytes()
+    end = header.size + 4 * len(instructions)
+    # Cut inside the first symbol's header, then inside its name.
+    for size in [end + 3, end + 7]:
+        object_file.write_bytes(data[:size])
+        with pytest.raises(ValueError, match="truncated"):
+            read_object(object_file)
+
+
+def test_not_an_object(object_file):
+    object_file.write_bytes(b"LMC code" * 4)
+    with pytest.raises(ValueError, match="not an LMC object"):
+        read_object(object_file)
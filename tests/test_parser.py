@@ -0,0 +1,53 @@
+import glob
+import io
+import re
+
+import pytest
+
+from nodes import Constant, Function, If, IfElse, Num, Op, Reference
+from parser import tokenize, tokenize_stream
+
+
+def stream(source, chunk_size=1 << 16):
+    return list(tokenize_stream(io.StringIO(source), chunk_size))
+
+
+def test_tree():
+    source = "fn (a b) { a b + } is add  1 ? { 2 } : { 3 @ } . add!"
+    assert tokenize(source) == [
+        Function(["a", "b"], [Reference("a"), Reference("b"), Op("+")]),
+        Constant("add"),
+        Num(1),
+        IfElse([Num(2)], [Num(3), Op("@")]),
+        Op("."),
+        Reference("add"),
+        Op("!"),
+    ]
+
+
+def test_empty():
+    assert tokenize("") == []
+    assert tokenize(" \n ") == []
+    assert stream("") == []
+
+
+@pytest.mark.parametrize("file_name", sorted(glob.glob("examples/*.bmc")))
+def test_stream_matches_tokenize(file_name):
+    with open(file_name) as file:
+        source = file.read()
+    expected = tokenize(source)
+    assert stream(source) == expected
+    # Lexemes split across chunk boundaries.
+    assert stream(source, 3) == expected
+
+
+@pytest.mark.parametrize("source, message", [
+    ("1 $ 2", "line 1, col 3"),
+    ("1 2\n} 3", "Expected end of string, found '}' at line 2, col 1."),
+    ("1 ? 2", "Expected end of string, found '?' at line 1, col 3."),
+    ("{ 1 }", "No match found at line 1, col 1."),
+    ("fn () { 1 }", "No match found at line 1, col 1."),
+])
+def test_errors(source, message):
+    with pytest.raises(Exception, match=re.escape(message)):
+        tokenize(source)
@@ -0,0 +1,62 @@
+import pytest
+
+import interpreter
+from channels import OutputChannel
+from compiler import compile
+from emulator import emulate
+from interpreter import Memo, interpret
+from parser import tokenize
+from resolver import Globals, resolve
+from tailcall import mark_tail_calls
+
+# Each call leaves a frame of at least three cells without tail calls, which
+# is more than the 256 cells of stack that compiled code gets by default.
+sum_to = """
+fn (n acc) {
+  n ? { n 1 - acc n + sum! } : { acc }
+} is sum
+200 0 sum! .
+"""
+
+
+def test_marks_tail_calls():
+    tokens = tokenize("fn (n) { n f! 1 + n ? { n g! } : { 1 h! } } is f  1 f!")
+    resolve(tokens, Globals())
+    mark_tail_calls(tokens)
+    body = tokens[0].block
+    assert not body[2].tail
+    assert body[6].block[2].tail
+    assert body[6].else_block[2].tail
+    assert not tokens[-1].tail
+
+
+def test_interpreter_reuses_frames(monkeypatch):
+    created = []
+
+    class Frame(interpreter.Frame):
+        __slots__ = ()
+
+        def __init__(self, routine):
+            super().__init__(routine)
+            created.append(self)
+
+    monkeypatch.setattr(interpreter, "Frame", Frame)
+    stdout = OutputChannel()
+    assert interpret(tokenize(sum_to), stdout) == []
+    assert stdout.getvalue() == "20100\n"
+    assert len(created) == 1
+
+
+def test_memoized_functions_keep_frames():
+    stdout = OutputChannel()
+    memo = Memo()
+    interpret(tokenize(sum_to), stdout, memo)
+    assert stdout.getvalue() == "20100\n"
+    assert memo.misses == 201
+
+
+@pytest.mark.parametrize("level", [0, 2])
+def test_compiled_tail_calls(level):
+    stdout = OutputChannel()
+    emulate(compile(tokenize(sum_to), level=level).instructions, stdout=stdout)
+    assert stdout.getvalue() == "20100\n"